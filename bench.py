@@ -0,0 +1,274 @@
+"""课程表解析与提醒流程基准测试
+
+用法：
+    python bench.py [--entries 100 1000 10000] [--repeat 5]
+    python bench.py --users 1000 10000 100000 [--templates 500] [--tick 60]
+
+--entries 生成包含指定数量课程块的合成课程表（一半为 "第1-16周" 这样的范围写法），
+统计 parse_timetable 的耗时和吞吐量。
+
+--users 生成指定人数的合成用户，每人一张完整学期的课程表（从 --templates 张不同的课程表中
+随机分配，模拟同班同学课程表相同的情况），然后：
+  - 统计课程表解析、冲突检测和 get_current_courses 的耗时
+  - 统计用户数据和提醒队列的内存占用
+  - 用模拟时钟按 --tick 秒一步走完学期中的一天，统计每步调度的 CPU 时间，
+    到期提醒经发送队列发给只记录 send_private_msg 调用的假机器人
+  - 统计次日汇总消息从生成到全部发送完成的耗时
+数据库等文件写在临时目录中，不影响 data/kcjqr。
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import nonebot
+
+nonebot.init(driver="~none")
+
+from main import (  # noqa: E402
+    WEEKDAY_NAMES, CourseTable, MessageDispatcher, parse_timetable, plugin,
+)
+
+
+def make_timetable(entries: int, seed: int = 0) -> str:
+    """生成合成课程表文本"""
+    rng = random.Random(seed)
+    lines = ["学期开始日期：2024-02-26", "总周数：16", ""]
+    for i in range(entries):
+        if i % 2:
+            week = f"{rng.randint(1, 8)}-{rng.randint(9, 16)}"
+        else:
+            week = str(rng.randint(1, 16))
+        period = rng.randint(1, 11)
+        lines.append(
+            f"第{week}周 星期{WEEKDAY_NAMES[rng.randint(0, 6)]} "
+            f"第{period}-{period + 1}节 课程{i}"
+        )
+        lines.append(f"地点：教学楼{rng.randint(100, 999)}")
+        lines.append(f"教师：教师{rng.randint(1, 200)}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def make_semester_timetable(seed: int, courses: int = 14) -> str:
+    """生成一张没有冲突的完整学期课程表：周一到周五，每门课两节连上"""
+    rng = random.Random(seed)
+    slots = [(weekday, period) for weekday in range(1, 6) for period in (1, 3, 5, 7, 9)]
+    lines = ["总周数：16", ""]
+    for i, (weekday, period) in enumerate(rng.sample(slots, courses)):
+        week = rng.choice(["1-16", "1-16", "1-8", "9-16", "2-15"])
+        lines.append(f"第{week}周 星期{WEEKDAY_NAMES[weekday - 1]} 第{period}-{period + 1}节 课程{seed}_{i}")
+        lines.append(f"地点：教学楼{rng.randint(100, 999)}")
+        lines.append(f"教师：教师{rng.randint(1, 200)}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def bench_parse(entries: int, repeat: int):
+    text = make_timetable(entries)
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        table, errors = parse_timetable(text)
+        best = min(best, time.perf_counter() - started)
+    assert not errors, errors[:3]
+    lines = text.count("\n") + 1
+    print(
+        f"parse  entries={entries:>6}  lines={lines:>6}  courses={len(table.courses):>6}  "
+        f"occurrences={table.occurrences():>7}  "
+        f"best={best * 1000:8.2f} ms  {lines / best:12.0f} lines/s"
+    )
+
+
+class StubBot:
+    """只记录 send_private_msg 调用的假机器人"""
+
+    self_id = "0"
+
+    def __init__(self):
+        self.calls = 0
+
+    async def send_private_msg(self, user_id: int, message: str):
+        self.calls += 1
+
+
+def mb(size: int) -> str:
+    return f"{size / 1024 / 1024:8.1f} MB"
+
+
+def build_population(users: int, templates: int) -> list:
+    """解析模板课程表并分配给合成用户，返回用户ID列表"""
+    texts = [make_semester_timetable(seed) for seed in range(templates)]
+    lines = sum(text.count("\n") + 1 for text in texts)
+
+    started = time.perf_counter()
+    tables = []
+    for text in texts:
+        table, errors = plugin.parse_course_info(text)
+        assert not errors, errors[:3]
+        tables.append(table)
+    elapsed = time.perf_counter() - started
+    print(f"  parse_course_info    tables={templates:>7}  {elapsed * 1000:10.2f} ms  {lines / elapsed:12.0f} lines/s")
+
+    started = time.perf_counter()
+    for table in tables:
+        assert not plugin.check_course_conflicts(table.courses)
+    elapsed = time.perf_counter() - started
+    print(f"  check_conflicts      tables={templates:>7}  {elapsed * 1000:10.2f} ms  "
+          f"{elapsed / templates * 1e6:10.1f} us/table")
+
+    rng = random.Random(users)
+    user_ids = [str(10 ** 8 + i) for i in range(users)]
+    tracemalloc.start()
+    for user_id in user_ids:
+        template = tables[rng.randrange(templates)]
+        plugin.user_courses[user_id] = CourseTable(template.basic_info, template.courses, True)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  user tables          users={users:>8}  {mb(current)}")
+    return user_ids
+
+
+def simulated_day() -> datetime.date:
+    """今天起第一个周一到周四，保证模拟的当天和次日都有课"""
+    day = datetime.date.today()
+    while day.weekday() > 3:
+        day += datetime.timedelta(days=1)
+    return day
+
+
+def set_semester(day: datetime.date):
+    """让 day 落在学期第 3 周"""
+    plugin.semester_config = {"start_date": (day - datetime.timedelta(days=14)).isoformat(), "total_weeks": 16}
+    plugin._semester_start = None
+    plugin._period_schedule = None
+
+
+async def simulate_day(user_ids: list, tick: int, bot: StubBot):
+    """用模拟时钟走完一天：每步弹出到期提醒并交给发送队列"""
+    scheduler = plugin.scheduler
+    day = simulated_day()
+    day_start = datetime.datetime.combine(day, datetime.time()).timestamp()
+
+    started = time.perf_counter()
+    for user_id in user_ids:
+        plugin.get_current_courses(user_id)
+    elapsed = time.perf_counter() - started
+    print(f"  get_current_courses  users={len(user_ids):>8}  {elapsed * 1000:10.2f} ms  "
+          f"{elapsed / len(user_ids) * 1e6:10.2f} us/user")
+
+    # 先在 tracemalloc 下规划一次统计内存，再不带 tracemalloc 重新规划统计 CPU 时间
+    scheduler.reindex()
+    tracemalloc.start()
+    scheduler.queue = []
+    scheduler.planned_until = day_start
+    scheduler._extend()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    scheduler.queue = []
+    scheduler.planned_until = day_start
+    started = time.process_time()
+    scheduler._extend()
+    plan_cpu = time.process_time() - started
+    print(f"  plan day             groups={len(scheduler.groups):>7}  entries={len(scheduler.queue):>6}  {plan_cpu * 1000:10.2f} ms cpu  {mb(current)}")
+
+    tick_cpu = []
+    due_total = 0
+    recipients = 0
+    deliver_wall = 0.0
+    now = day_start
+    while now < day_start + 86400:
+        started = time.process_time()
+        while scheduler.planned_until - now < 86400:
+            scheduler._extend()
+        due = scheduler.pop_due(now)
+        tick_cpu.append(time.process_time() - started)
+
+        if due:
+            due_total += len(due)
+            recipients += sum(len(user_ids) for user_ids, _, _ in due)
+            started = time.perf_counter()
+            await asyncio.gather(*(scheduler._deliver(user_ids, week, course) for user_ids, week, course in due))
+            deliver_wall += time.perf_counter() - started
+        now += tick
+
+    tick_cpu.sort()
+    print(f"  scheduler ticks      ticks={len(tick_cpu):>8}  mean={sum(tick_cpu) / len(tick_cpu) * 1e3:8.3f} ms  "
+          f"p99={tick_cpu[int(len(tick_cpu) * 0.99)] * 1e3:8.3f} ms  max={tick_cpu[-1] * 1e3:8.3f} ms cpu")
+    print(f"  reminders            due={due_total:>10}  recipients={recipients:>8}  sent={bot.calls:>8}  "
+          f"delivery={deliver_wall:8.2f} s")
+
+
+async def bench_digest(user_ids: list, bot: StubBot):
+    """生成并发送次日汇总消息（不分散发送）"""
+    day = simulated_day() + datetime.timedelta(days=1)
+    sent_before = bot.calls
+
+    started = time.perf_counter()
+    await plugin.precompute_digests(day, user_ids)
+    precompute = time.perf_counter() - started
+    await plugin.send_digests(bot, day, time.time(), 0, user_ids)
+    total = time.perf_counter() - started
+    print(f"  daily digest         sent={bot.calls - sent_before:>9}  precompute={precompute:8.2f} s  "
+          f"completed={total:8.2f} s")
+
+
+async def bench_population(users: int, templates: int, tick: int):
+    print(f"population users={users}")
+    plugin.user_courses = {}
+    plugin.digest_cache = {}
+    plugin.ledger.entries = {}
+    set_semester(simulated_day())
+    user_ids = build_population(users, templates)
+
+    bot = StubBot()
+    plugin.bot = plugin.scheduler.bot = bot
+    # 不限速，只测量发送队列本身的开销
+    plugin.dispatcher.stop()
+    plugin.dispatcher = MessageDispatcher(concurrency=64, rate=1e9, burst=10 ** 9, max_retries=0)
+
+    await simulate_day(user_ids, tick, bot)
+    await bench_digest(user_ids, bot)
+    plugin.writer.drain()
+
+
+async def run_populations(args):
+    workdir = tempfile.mkdtemp(prefix="kcjqr-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        await plugin.startup()
+        for users in args.users:
+            await bench_population(users, args.templates, args.tick)
+        plugin.terminate()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--entries", type=int, nargs="*", default=None)
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--users", type=int, nargs="*", default=[])
+    arg_parser.add_argument("--templates", type=int, default=500)
+    arg_parser.add_argument("--tick", type=int, default=60)
+    args = arg_parser.parse_args()
+
+    # 默认只跑解析基准，与原来的行为一致
+    if args.entries is None and not args.users:
+        args.entries = [100, 1000, 10000]
+    for entries in args.entries or []:
+        bench_parse(entries, args.repeat)
+    if args.users:
+        asyncio.run(run_populations(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,38 @@
+import bisect
+import collections
+import contextlib
+import csv
 import datetime
+import gzip
+import hashlib
 import json
 import os
+import queue
+import sys
+import re
 import asyncio
+import heapq
+import io
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+import zoneinfo
 from dateutil import parser
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import resource
+except ImportError:
+    resource = None
 from nonebot import on_message
 from nonebot.rule import to_me
 from nonebot.adapters.onebot.v11 import Bot, Event
 from nonebot.typing import T_State
+from nonebot.permission import SUPERUSER
 from nonebot import get_driver
 from nonebot import require
 
@@ -14,331 +40,2118 @@ from nonebot import require
 driver = get_driver()
 plugin_config = driver.config
 
-# 创建数据目录
-os.makedirs("data/kcjqr", exist_ok=True)
+# 数据目录
+DATA_DIR = "data/kcjqr"
+
+WEEKDAY_NAMES = "一二三四五六日"
+
+# 课程表解析用的正则
+_RANGE = r"(\d+)(?:\s*[-~～－至]\s*(\d+))?"
+HEADER_RE = re.compile(r"(学期开始日期|总周数)\s*[:：]\s*(.*)")
+COURSE_RE = re.compile(
+    rf"第\s*{_RANGE}\s*周\s*(?:星期|周)([一二三四五六日天])\s*第\s*{_RANGE}\s*节\s*(.*)"
+)
+FIELD_RE = re.compile(r"[^:：]*?(地点|教师)\s*[:：]\s*(.*)")  # 允许 "上课地点"、"任课教师" 这样的标签
+FIELD_KEYS = {"地点": "location", "教师": "teacher"}
+MAX_WEEKS = 60  # 课程表未写总周数时允许的最大周次
+MAX_PERIODS = 20  # 一天最多的节次
+
+
+def parse_week_ranges(text: str) -> int:
+    """把 "1-8,10,12-16" 形式的周次文本转换为位掩码"""
+    mask = 0
+    for part in text.split(","):
+        start, _, end = part.partition("-")
+        start, end = int(start), int(end or start)
+        mask |= ((1 << (end - start + 1)) - 1) << start
+    return mask
+
+
+def format_week_ranges(mask: int) -> str:
+    """把位掩码转换为 "1-8,10,12-16" 形式的周次文本"""
+    parts = []
+    week = 0
+    while mask >> week:
+        if not (mask >> week) & 1:
+            week += 1
+            continue
+        start = week
+        while (mask >> (week + 1)) & 1:
+            week += 1
+        parts.append(str(start) if start == week else f"{start}-{week}")
+        week += 1
+    return ",".join(parts)
+
+
+class Course:
+    """一门课程：固定的星期和节次，上课周次用位掩码保存"""
+
+    __slots__ = ("name", "location", "teacher", "weekday", "period", "period_end", "weeks")
+
+    def __init__(self, name: str, location: str, teacher: str, weekday: int,
+                 period: int, period_end: int, weeks: int):
+        self.name = sys.intern(name)
+        self.location = sys.intern(location)
+        self.teacher = sys.intern(teacher)
+        self.weekday = weekday
+        self.period = period
+        self.period_end = period_end
+        self.weeks = weeks
+
+    def has_week(self, week: int) -> bool:
+        return (self.weeks >> week) & 1 == 1
+
+    def key(self) -> tuple:
+        """除周次以外的全部字段，相同的课程可以合并周次"""
+        return self.name, self.location, self.teacher, self.weekday, self.period, self.period_end
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "location": self.location,
+            "teacher": self.teacher,
+            "weekday": self.weekday,
+            "period": self.period,
+            "period_end": self.period_end,
+            "weeks": format_week_ranges(self.weeks),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Course":
+        return cls(
+            data["name"], data.get("location", ""), data.get("teacher", ""), data["weekday"],
+            data["period"], data.get("period_end", data["period"]), parse_week_ranges(data["weeks"]),
+        )
+
+
+class SlotMap:
+    """(星期, 节次) -> 占用该时段的课程，并记录每个时段已占用周次的并集用于快速排除"""
+
+    __slots__ = ("slots", "union")
+
+    def __init__(self, courses: list = ()):
+        self.slots = {}
+        self.union = {}
+        for course in courses:
+            self.add(course)
+
+    def add(self, course: Course):
+        for period in range(course.period, course.period_end + 1):
+            slot = (course.weekday, period)
+            self.slots.setdefault(slot, []).append(course)
+            self.union[slot] = self.union.get(slot, 0) | course.weeks
+
+    def find(self, course: Course) -> list:
+        """与 course 冲突的课程，返回 (课程, 冲突周次掩码)"""
+        found = {}
+        for period in range(course.period, course.period_end + 1):
+            slot = (course.weekday, period)
+            if not self.union.get(slot, 0) & course.weeks:
+                continue
+            for other in self.slots[slot]:
+                overlap = other.weeks & course.weeks
+                if overlap and id(other) not in found:
+                    found[id(other)] = (other, overlap)
+        return list(found.values())
+
+
+class CourseSet:
+    """按内容去重的一组课程及其派生索引，课程相同的用户共用同一个对象
+
+    创建后不再修改，追加课程时生成新的集合；没有课程表引用时自动释放。
+    """
+
+    __slots__ = ("courses", "digest", "_by_weekday", "_slots", "_rendered", "__weakref__")
+
+    _catalog = weakref.WeakValueDictionary()  # 内容哈希 -> 课程集合
+    _lock = threading.Lock()
+
+    def __init__(self, courses: list, digest: str):
+        self.courses = courses
+        self.digest = digest
+        self._by_weekday = None
+        self._slots = None
+        self._rendered = None  # (作息时间表, {周次: 分页后的课程列表文本（不含用户的学期信息）})
+
+    @staticmethod
+    def fingerprint(courses: list) -> str:
+        """与顺序无关的内容哈希"""
+        # 周次掩码用十六进制表示，不受整数转十进制字符串的位数限制
+        return hashlib.sha1(repr(sorted((*course.key(), f"{course.weeks:x}") for course in courses)).encode()).hexdigest()
+
+    @classmethod
+    def intern(cls, courses: list) -> "CourseSet":
+        """返回内容相同的已有集合，没有时创建"""
+        digest = cls.fingerprint(courses)
+        with cls._lock:
+            course_set = cls._catalog.get(digest)
+            if course_set is None:
+                course_set = cls._catalog[digest] = cls(courses, digest)
+        return course_set
+
+    @classmethod
+    def catalog_size(cls) -> int:
+        return len(cls._catalog)
+
+    def courses_on(self, week: int, weekday: int) -> list:
+        """某周某天的课程，按节次排序"""
+        if self._by_weekday is None:
+            by_weekday = {}
+            for course in sorted(self.courses, key=lambda c: c.period):
+                by_weekday.setdefault(course.weekday, []).append(course)
+            self._by_weekday = by_weekday
+        return [course for course in self._by_weekday.get(weekday, ()) if course.has_week(week)]
+
+    def slot_map(self) -> SlotMap:
+        """时段占用表（首次使用时建立）"""
+        if self._slots is None:
+            self._slots = SlotMap(self.courses)
+        return self._slots
+
+    def render_cache(self, schedule) -> dict:
+        """课程表文本的缓存，更换作息时间表后自动清空"""
+        if self._rendered is None or self._rendered[0] is not schedule:
+            self._rendered = (schedule, {})
+        return self._rendered[1]
+
+
+class CourseTable:
+    """一个用户的课程表，课程部分与内容相同的其他用户共用"""
+
+    __slots__ = ("basic_info", "course_set", "reminder_enabled", "timezone")
+
+    def __init__(self, basic_info: dict = None, courses: list = None, reminder_enabled: bool = False,
+                 timezone: str = ""):
+        self.basic_info = basic_info or {}
+        self.course_set = CourseSet.intern(self.merge(courses or []))
+        self.reminder_enabled = reminder_enabled
+        self.timezone = timezone  # IANA 时区名，为空时使用服务器本地时区
+
+    @property
+    def courses(self) -> list:
+        return self.course_set.courses
+
+    @staticmethod
+    def merge(courses: list) -> list:
+        """合并除周次外完全相同的课程（不修改传入的课程，它们可能被其他课程表共用）"""
+        merged = {}
+        for course in courses:
+            key = course.key()
+            existing = merged.get(key)
+            merged[key] = course if existing is None else Course(*key, existing.weeks | course.weeks)
+        return list(merged.values())
+
+    def courses_on(self, week: int, weekday: int) -> list:
+        """某周某天的课程，按节次排序"""
+        return self.course_set.courses_on(week, weekday)
+
+    def slot_map(self) -> SlotMap:
+        """时段占用表"""
+        return self.course_set.slot_map()
+
+    def extend(self, courses: list):
+        """追加课程，生成新的共享课程集合"""
+        self.course_set = CourseSet.intern(self.merge([*self.courses, *courses]))
+
+    def render_cache(self, schedule) -> dict:
+        """课程表文本的缓存"""
+        return self.course_set.render_cache(schedule)
+
+    def occurrences(self) -> int:
+        """按周展开后的上课次数"""
+        return sum(bin(course.weeks).count("1") for course in self.courses)
+
+    def to_dict(self) -> dict:
+        data = {
+            "basic_info": self.basic_info,
+            "courses": [course.to_dict() for course in self.courses],
+        }
+        if self.timezone:
+            data["timezone"] = self.timezone
+        return data
+
+    def snapshot(self) -> tuple:
+        """写入存储用的快照 (课程表数据, 是否开启提醒)，之后修改课程表不影响快照"""
+        return self.to_dict(), self.reminder_enabled
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CourseTable":
+        """读取课程表，旧版每周一条记录的格式会自动合并"""
+        courses = []
+        for item in data.get("courses", []):
+            if "week" in item:
+                item = dict(item, weeks=str(item["week"]))
+            courses.append(Course.from_dict(item))
+        return cls(data.get("basic_info", {}), courses, data.get("reminder_enabled", False),
+                   data.get("timezone", ""))
+
+
+class PeriodSchedule:
+    """作息时间表：每节课的开始、结束时间（距零点的分钟数）预先编译成数组，查询为常数时间"""
+
+    __slots__ = ("starts", "ends", "start_labels", "end_labels")
+
+    def __init__(self, periods: list):
+        self.starts = [0]  # 下标即节次，第 0 项占位
+        self.ends = [0]
+        for item in periods:
+            start, _, end = item.partition("-")
+            start, end = self._to_minutes(start), self._to_minutes(end)
+            period = len(self.starts)
+            if end <= start:
+                raise ValueError(f"第{period}节的结束时间应晚于开始时间：{item}")
+            if start < self.ends[-1]:
+                raise ValueError(f"第{period}节的开始时间不能早于第{period - 1}节的结束时间：{item}")
+            self.starts.append(start)
+            self.ends.append(end)
+        self.start_labels = [f"{m // 60:02d}:{m % 60:02d}" for m in self.starts]
+        self.end_labels = [f"{m // 60:02d}:{m % 60:02d}" for m in self.ends]
+
+    @staticmethod
+    def _to_minutes(text: str) -> int:
+        """HH:MM 转为距零点的分钟数，只接受当天的时刻（00:00-23:59）"""
+        hour, _, minute = text.strip().partition(":")
+        if not (hour.isdigit() and minute.isdigit() and int(hour) < 24 and int(minute) < 60):
+            raise ValueError(f"时间应为 00:00-23:59 之间的 HH:MM：{text.strip()}")
+        return int(hour) * 60 + int(minute)
+
+    @classmethod
+    def default(cls, count: int = 12) -> "PeriodSchedule":
+        """未配置作息时间时，从 08:00 起每节 45 分钟连续排列"""
+        return cls([
+            f"{(480 + i * 45) // 60}:{(480 + i * 45) % 60:02d}-{(525 + i * 45) // 60}:{(525 + i * 45) % 60:02d}"
+            for i in range(count)
+        ])
+
+    def _extend(self, period: int):
+        """节次超出作息表时，按每节 45 分钟、课间 10 分钟向后推算，最晚排到当天 23:59"""
+        while len(self.starts) <= period:
+            start = min(self.ends[-1] + 10, 24 * 60 - 1 - 45)
+            self.starts.append(start)
+            self.ends.append(start + 45)
+            self.start_labels.append(f"{start // 60:02d}:{start % 60:02d}")
+            self.end_labels.append(f"{(start + 45) // 60:02d}:{(start + 45) % 60:02d}")
+
+    def span(self, period: int, period_end: int) -> tuple:
+        """第 period 到 period_end 节的开始、结束分钟数"""
+        if period_end >= len(self.starts):
+            self._extend(period_end)
+        return self.starts[period], self.ends[period_end]
+
+    def label(self, period: int, period_end: int) -> str:
+        """时间文本，如 08:00-09:40"""
+        if period_end >= len(self.starts):
+            self._extend(period_end)
+        return f"{self.start_labels[period]}-{self.end_labels[period_end]}"
+
+
+def format_periods(course: Course) -> str:
+    """节次文本，跨多节时为 "1-2" 形式"""
+    if course.period_end == course.period:
+        return str(course.period)
+    return f"{course.period}-{course.period_end}"
+
+
+def parse_timetable(text: str) -> tuple:
+    """单次扫描解析课程表文本
+
+    支持 "第1-16周"、"第1-2节" 这样的范围写法，周次保存为位掩码，
+    不同课程块里除周次外相同的课程会合并。第一个课程块之前无法识别的行（如标题）直接跳过。
+    返回 (课程表, 错误列表)，错误为 (行号, 说明)。
+    """
+    basic_info = {}
+    courses = []
+    course_lines = []  # 每门课程所在的行号和最大周次，总周数可能写在课程之后，最后统一检查
+    errors = []
+    current = None  # 当前课程块，随后的地点/教师写入其中
+    seen_course = False  # 是否已经出现过课程行
+
+    for line_no, raw in enumerate(io.StringIO(text), 1):
+        line = raw.strip()
+        if not line:
+            continue
+
+        match = COURSE_RE.match(line)
+        if match:
+            week_start, week_end, weekday, period, period_end, name = match.groups()
+            week_start = int(week_start)
+            week_end = int(week_end or week_start)
+            period = int(period)
+            period_end = int(period_end or period)
+            name = name.strip()
+            current = None
+            seen_course = True
+            if not 1 <= week_start <= week_end:
+                errors.append((line_no, f"周次范围无效：{line}"))
+            elif week_end > MAX_WEEKS:
+                errors.append((line_no, f"周次超出范围（最多{MAX_WEEKS}周）：{line}"))
+            elif not 1 <= period <= period_end:
+                errors.append((line_no, f"节次范围无效：{line}"))
+            elif period_end > MAX_PERIODS:
+                errors.append((line_no, f"节次超出范围（最多{MAX_PERIODS}节）：{line}"))
+            elif not name:
+                errors.append((line_no, f"缺少课程名称：{line}"))
+            else:
+                current = {
+                    "name": name,
+                    "location": "",
+                    "teacher": "",
+                    "weekday": WEEKDAY_NAMES.index(weekday.replace("天", "日")) + 1,
+                    "period": period,
+                    "period_end": period_end,
+                    "weeks": ((1 << (week_end - week_start + 1)) - 1) << week_start,
+                }
+                courses.append(current)
+                course_lines.append((line_no, week_end, line))
+            continue
+
+        match = FIELD_RE.match(line)
+        if match:
+            if current is None:
+                errors.append((line_no, f"{match.group(1)}不属于任何课程：{line}"))
+            else:
+                current[FIELD_KEYS[match.group(1)]] = match.group(2).strip()
+            continue
+
+        match = HEADER_RE.match(line)
+        if match:
+            key, value = match.group(1), match.group(2).strip()
+            if key == "学期开始日期":
+                basic_info["start_date"] = value
+            elif value.isdigit() and 1 <= int(value) <= MAX_WEEKS:
+                basic_info["total_weeks"] = int(value)
+            else:
+                errors.append((line_no, f"总周数应为 1-{MAX_WEEKS} 的整数：{line}"))
+            continue
+
+        if seen_course:
+            errors.append((line_no, f"无法识别：{line}"))
+
+    total_weeks = basic_info.get("total_weeks")
+    if total_weeks is not None:
+        for line_no, week_end, line in course_lines:
+            if week_end > total_weeks:
+                errors.append((line_no, f"周次超出总周数（{total_weeks}周）：{line}"))
+        errors.sort(key=lambda error: error[0])
+
+    return CourseTable(basic_info, [Course(**course) for course in courses]), errors
+
+
+def find_conflicts(courses: list, existing: CourseTable = None) -> list:
+    """检查课程冲突，返回 (课程1, 课程2, 冲突周次掩码)
+
+    一次扫描完成：每门课只与时段占用表中相同 (星期, 节次) 的课程比较，跨多节的课程逐节检查。
+    传入 existing 时同时检查与已有课程表的冲突，已有课程之间不再重复检查。
+    """
+    conflicts = []
+    slots = SlotMap()
+    for course in courses:
+        if existing is not None:
+            conflicts.extend((other, course, overlap) for other, overlap in existing.slot_map().find(course))
+        conflicts.extend((other, course, overlap) for other, overlap in slots.find(course))
+        slots.add(course)
+    return conflicts
+
+
+def format_conflicts(conflicts: list) -> str:
+    """格式化冲突信息"""
+    msg = "发现课程冲突：\n"
+    for c1, c2, weeks in conflicts:
+        start, end = max(c1.period, c2.period), min(c1.period_end, c2.period_end)
+        msg += f"\n{c1.name} 与 {c2.name} 在"
+        msg += f"第{format_week_ranges(weeks)}周 星期{WEEKDAY_NAMES[c1.weekday - 1]} "
+        msg += f"第{start if start == end else f'{start}-{end}'}节 冲突\n"
+    return msg
+
+
+def read_import_source(path: str) -> list:
+    """读取批量导入的课程表，返回 [(用户ID, 课程表文本)]
+
+    支持三种来源：
+    - CSV 文件：表头包含 user_id 和 timetable 两列
+    - JSON 文件：{用户ID: 课程表文本}，或 [{"user_id": ..., "timetable": ...}] 列表
+    - 目录：每个用户一个 <用户ID>.txt 文件
+    """
+    if os.path.isdir(path):
+        items = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".txt"):
+                with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+                    items.append((name[:-4], f.read()))
+        return items
+    
+    if path.endswith(".csv"):
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            reader = csv.DictReader(f)
+            if not {"user_id", "timetable"} <= set(reader.fieldnames or ()):
+                raise ValueError("CSV 文件需要包含 user_id 和 timetable 两列")
+            return [(row["user_id"].strip(), row["timetable"]) for row in reader]
+    
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            return [(str(user_id), text) for user_id, text in data.items()]
+        if isinstance(data, list):
+            return [(str(item["user_id"]), item["timetable"]) for item in data]
+        raise ValueError("JSON 文件应为 {用户ID: 课程表} 或 [{\"user_id\", \"timetable\"}] 格式")
+    
+    raise ValueError("只支持 .csv、.json 文件或包含 <用户ID>.txt 的目录")
+
+
+def import_timetable(item: tuple) -> tuple:
+    """批量导入时解析并检查一个用户的课程表，返回 (用户ID, 课程表, 错误信息)
+
+    有错误时课程表为 None。
+    """
+    user_id, text = item
+    if not user_id.isdigit():
+        return user_id, None, "用户ID应为QQ号"
+    if not isinstance(text, str):
+        return user_id, None, "课程表应为文本"
+    table, errors = parse_timetable(text)
+    if errors:
+        line_no, error = errors[0]
+        return user_id, None, f"第{line_no}行：{error}" + (f" 等 {len(errors)} 处错误" if len(errors) > 1 else "")
+    if not table.courses:
+        return user_id, None, "没有识别到课程"
+    conflicts = find_conflicts(table.courses)
+    if conflicts:
+        c1, c2, _ = conflicts[0]
+        return user_id, None, f"{c1.name} 与 {c2.name} 冲突" + (f" 等 {len(conflicts)} 处冲突" if len(conflicts) > 1 else "")
+    return user_id, table, ""
+
+
+def import_timetables(items: list, histogram: "Histogram" = None) -> list:
+    """在后台线程中逐个执行 import_timetable，histogram 记录每个课程表的处理耗时
+
+    不使用进程池：fork 出的子进程会继承事件循环、写入线程和数据库连接，可能因为锁而卡死；
+    spawn 方式启动的子进程又无法导入依赖 NoneBot 的插件模块。
+    """
+    results = []
+    for item in items:
+        if histogram is None:
+            results.append(import_timetable(item))
+            continue
+        with histogram.time():
+            results.append(import_timetable(item))
+    return results
+
+
+# 数据存储
+class CourseStorage:
+    """SQLite（WAL 模式）存储，每个用户一行，只写入发生变化的用户"""
+
+    def __init__(self, path: str = os.path.join(DATA_DIR, "kcjqr.db")):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def open(self):
+        """打开数据库并建表（在加载数据时调用，可以放在线程中执行）"""
+        if self.conn is not None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, reminder_enabled INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS deliveries (key TEXT PRIMARY KEY, expires_at INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    def migrate_json(self, data_dir: str = DATA_DIR):
+        """一次性把旧版 JSON 文件导入数据库，导入后的文件加上 .migrated 后缀"""
+        files = {
+            name: os.path.join(data_dir, f"{name}.json")
+            for name in ("courses", "reminder_status", "semester_config")
+        }
+        if not any(os.path.exists(path) for path in files.values()):
+            return
+
+        loaded = {}
+        for name, path in files.items():
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    loaded[name] = json.load(f)
+
+        user_courses = {
+            user_id: CourseTable.from_dict(data)
+            for user_id, data in loaded.get("courses", {}).items()
+        }
+        for user_id, status in loaded.get("reminder_status", {}).items():
+            if user_id in user_courses:
+                user_courses[user_id].reminder_enabled = status
+
+        self.write({user_id: table.snapshot() for user_id, table in user_courses.items()},
+                   loaded.get("semester_config"))
+        for path in files.values():
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+        print(f"已将 {len(user_courses)} 个用户的数据从 JSON 迁移到 {self.path}")
+
+    def load_all(self) -> tuple:
+        """读取全部用户数据和学期配置"""
+        with self.lock:
+            user_courses = {}
+            legacy = {}  # 仍是每周一条记录的旧格式，读取后转换写回
+            for user_id, data, enabled in self.conn.execute(
+                "SELECT user_id, data, reminder_enabled FROM users"
+            ):
+                data = json.loads(data)
+                table = user_courses[user_id] = CourseTable.from_dict(data)
+                table.reminder_enabled = bool(enabled)
+                if any("week" in item for item in data.get("courses", [])):
+                    legacy[user_id] = table
+
+            row = self.conn.execute("SELECT value FROM config WHERE key = 'semester'").fetchone()
+            semester_config = json.loads(row[0]) if row else None
+
+        if legacy:
+            self.write({user_id: table.snapshot() for user_id, table in legacy.items()})
+        return user_courses, semester_config
+
+    def write(self, users: dict, semester_config: dict = None, replace: bool = False):
+        """在一个事务里写入若干用户的快照（值为 None 表示删除）和学期配置
+
+        replace 为 True 时先清空原有的用户数据和学期配置。
+        """
+        rows, deleted = [], []
+        for user_id, snapshot in users.items():
+            if snapshot is None:
+                deleted.append((user_id,))
+                continue
+            data, enabled = snapshot
+            rows.append((
+                user_id,
+                json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+                int(enabled),
+            ))
+
+        with self.lock, self.conn:
+            if replace:
+                self.conn.execute("DELETE FROM users")
+                self.conn.execute("DELETE FROM config WHERE key = 'semester'")
+            if rows:
+                self.conn.executemany(
+                    "INSERT INTO users (user_id, data, reminder_enabled) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET "
+                    "data = excluded.data, reminder_enabled = excluded.reminder_enabled",
+                    rows,
+                )
+            if deleted:
+                self.conn.executemany("DELETE FROM users WHERE user_id = ?", deleted)
+            if semester_config is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO config (key, value) VALUES ('semester', ?)",
+                    (json.dumps(semester_config, ensure_ascii=False),),
+                )
+
+    def replace_all(self, users: dict, semester_config: dict = None):
+        """在一个事务里用一组快照替换全部用户数据和学期配置（恢复备份时使用）"""
+        self.write(users, semester_config, replace=True)
+
+    def load_deliveries(self, now: float) -> dict:
+        """删除过期的发送记录，返回剩余记录 {键: 过期时间}"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM deliveries WHERE expires_at <= ?", (int(now),))
+            return dict(self.conn.execute("SELECT key, expires_at FROM deliveries"))
+
+    def write_deliveries(self, changes: dict):
+        """在一个事务里写入一批发送记录：{键: 过期时间}，过期时间为 None 表示删除"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO deliveries (key, expires_at) VALUES (?, ?)",
+                [(key, int(expires_at)) for key, expires_at in changes.items() if expires_at is not None],
+            )
+            self.conn.executemany(
+                "DELETE FROM deliveries WHERE key = ?",
+                [(key,) for key, expires_at in changes.items() if expires_at is None],
+            )
+
+    def purge_deliveries(self, now: float):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM deliveries WHERE expires_at <= ?", (int(now),))
+
+    def backup(self, path: str):
+        """把数据库完整复制到 path"""
+        with self.lock:
+            dest = sqlite3.connect(path)
+            try:
+                self.conn.backup(dest)
+            finally:
+                dest.close()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+# 耗时直方图
+class Histogram:
+    """Prometheus 风格的累积直方图，单位为秒，可在写入线程和事件循环中同时使用"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶为 +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    @contextlib.contextmanager
+    def time(self):
+        """统计 with 块的耗时"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    @property
+    def avg(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """按桶估算分位数（返回所在桶的上界，不超过最大值）"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+# 后台写入队列
+class WriteBehindQueue:
+    """在单独的线程中按提交顺序执行写入任务，事件循环只负责提交
+
+    记录队列深度和每次写入的耗时，stop() 会先执行完队列中剩余的任务。
+    """
+
+    def __init__(self, name: str = "kcjqr-writer"):
+        self.name = name
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.completed = 0  # 已完成的写入任务数
+        self.errors = 0  # 出错的写入任务数
+        self.latency = Histogram()  # 从提交到完成的耗时
+        self.duration = Histogram()  # 任务本身的执行耗时
+        self.last_latency = 0.0
+
+    def submit(self, func, *args):
+        """提交写入任务"""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+        self.jobs.put((func, args, time.monotonic()))
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            func, args, submitted_at = job
+            try:
+                with self.duration.time():
+                    func(*args)
+            except Exception as e:
+                self.errors += 1
+                print(f"写入数据失败: {e}")
+            latency = time.monotonic() - submitted_at
+            self.completed += 1
+            self.last_latency = latency
+            self.latency.observe(latency)
+            self.jobs.task_done()
+
+    def drain(self):
+        """等待队列中的任务全部完成"""
+        if self.thread is not None and self.thread.is_alive():
+            self.jobs.join()
+
+    def stop(self):
+        """执行完剩余任务后停止线程"""
+        if self.thread is not None and self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        self.thread = None
+
+    def stats(self) -> dict:
+        """队列深度和写入耗时统计"""
+        return {
+            "queue_depth": self.jobs.qsize(),
+            "completed": self.completed,
+            "errors": self.errors,
+            "latency_last": self.last_latency,
+            "latency_avg": self.latency.avg,
+            "latency_max": self.latency.max,
+        }
+
+
+# 增量备份
+class BackupStore:
+    """按内容寻址的增量备份
+
+    每个用户的记录按内容的 SHA-256 存为 objects/<前两位>/<哈希>，内容不变的记录只存一份；
+    每次备份只写一个快照清单 snapshots/<时间>.json，列出各用户记录的哈希。
+    """
+
+    EXTENSIONS = {"gzip": ".json.gz", "zstd": ".json.zst", "none": ".json"}
+
+    def __init__(self, root: str = os.path.join(DATA_DIR, "backup"), compression: str = "gzip",
+                 keep_hourly: int = 24, keep_daily: int = 7, keep_weekly: int = 4):
+        if compression == "zstd" and zstandard is None:
+            print("未安装 zstandard，备份改用 gzip 压缩")
+            compression = "gzip"
+        self.root = root
+        self.compression = compression
+        self.keep_hourly = keep_hourly
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.last_users = None  # 最近一次快照中的 {用户ID: 哈希}
+        self.refs = None  # 对象哈希 -> 被现存快照引用的次数，首次使用时从快照清单统计
+
+    def _object_path(self, digest: str, compression: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest + self.EXTENSIONS[compression])
+
+    def _put(self, record) -> str:
+        """保存一条记录，返回其哈希；相同内容已存在时不再写入"""
+        raw = json.dumps(record, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha256(raw).hexdigest()
+        if any(os.path.exists(self._object_path(digest, c)) for c in self.EXTENSIONS):
+            return digest
+
+        if self.compression == "gzip":
+            raw = gzip.compress(raw)
+        elif self.compression == "zstd":
+            raw = zstandard.ZstdCompressor().compress(raw)
+        path = self._object_path(digest, self.compression)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(raw)
+        os.replace(path + ".tmp", path)
+        return digest
+
+    def _get(self, digest: str):
+        for compression, ext in self.EXTENSIONS.items():
+            path = self._object_path(digest, compression)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                raw = f.read()
+            if compression == "gzip":
+                raw = gzip.decompress(raw)
+            elif compression == "zstd":
+                if zstandard is None:
+                    raise RuntimeError("该备份使用 zstd 压缩，需要安装 zstandard")
+                raw = zstandard.ZstdDecompressor().decompress(raw)
+            return json.loads(raw)
+        raise FileNotFoundError(f"备份对象不存在：{digest}")
+
+    def list_snapshots(self) -> list:
+        """全部快照名称，按时间从旧到新排列"""
+        directory = os.path.join(self.root, "snapshots")
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name[:-5] for name in os.listdir(directory) if name.endswith(".json"))
+
+    def _read_manifest(self, name: str) -> dict:
+        with open(os.path.join(self.root, "snapshots", f"{name}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _manifest_refs(manifest: dict) -> list:
+        """快照清单引用的全部对象哈希"""
+        refs = list(manifest["users"].values())
+        if manifest["semester"]:
+            refs.append(manifest["semester"])
+        return refs
+
+    def _load_refs(self):
+        """统计现存快照对各对象的引用次数（只在启动后第一次备份时读取全部清单）"""
+        if self.refs is None:
+            self.refs = collections.Counter()
+            for name in self.list_snapshots():
+                self.refs.update(self._manifest_refs(self._read_manifest(name)))
+
+    def create(self, changes: dict, semester_config: dict = None) -> str:
+        """在上一个快照的基础上应用变更（{用户ID: 快照或 None}）生成新快照，返回快照名称"""
+        if self.last_users is None:
+            snapshots = self.list_snapshots()
+            self.last_users = self._read_manifest(snapshots[-1])["users"] if snapshots else {}
+
+        users = dict(self.last_users)
+        for user_id, snapshot in changes.items():
+            if snapshot is None:
+                users.pop(user_id, None)
+            else:
+                data, enabled = snapshot
+                users[user_id] = self._put({"data": data, "reminder_enabled": enabled})
+
+        self._load_refs()
+        now = datetime.datetime.now()
+        name = now.strftime("%Y%m%d_%H%M%S")
+        manifest = {
+            "created": now.isoformat(timespec="seconds"),
+            "semester": self._put(semester_config) if semester_config else None,
+            "users": users,
+        }
+        path = os.path.join(self.root, "snapshots", f"{name}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+        self.last_users = users
+        self.refs.update(self._manifest_refs(manifest))
+
+        self.prune()
+        return name
+
+    def load(self, name: str) -> tuple:
+        """读取快照，返回 ({用户ID: 课程表}, 学期配置)"""
+        manifest = self._read_manifest(name)
+        cache = {}  # 相同内容的记录只解压一次
+        user_courses = {}
+        for user_id, digest in manifest["users"].items():
+            if digest not in cache:
+                cache[digest] = self._get(digest)
+            record = cache[digest]
+            table = CourseTable.from_dict(record["data"])
+            table.reminder_enabled = record["reminder_enabled"]
+            user_courses[user_id] = table
+        semester_config = self._get(manifest["semester"]) if manifest["semester"] else None
+        return user_courses, semester_config
+
+    def prune(self):
+        """按保留策略删除旧快照，再删除不再被引用的对象
+
+        最新的快照总是保留；另外保留最近 keep_hourly 个小时、keep_daily 天、keep_weekly 周中各自最新的一个。
+        """
+        snapshots = self.list_snapshots()
+        keep = set(snapshots[-1:])
+        for count, bucket in (
+            (self.keep_hourly, lambda t: t[:11]),
+            (self.keep_daily, lambda t: t[:8]),
+            (self.keep_weekly, lambda t: datetime.datetime.strptime(t[:8], "%Y%m%d").isocalendar()[:2]),
+        ):
+            seen = set()
+            for name in reversed(snapshots):
+                key = bucket(name)
+                if key in seen:
+                    continue
+                if len(seen) >= count:
+                    break
+                seen.add(key)
+                keep.add(name)
+
+        removed = [name for name in snapshots if name not in keep]
+        if not removed:
+            return
+
+        # 只读取被删除的清单，引用计数归零的对象随之删除，不需要扫描保留的快照和整个 objects 目录
+        self._load_refs()
+        for name in removed:
+            manifest = self._read_manifest(name)
+            os.remove(os.path.join(self.root, "snapshots", f"{name}.json"))
+            for digest in self._manifest_refs(manifest):
+                self.refs[digest] -= 1
+                if self.refs[digest] > 0:
+                    continue
+                del self.refs[digest]
+                for compression in self.EXTENSIONS:
+                    path = self._object_path(digest, compression)
+                    if os.path.exists(path):
+                        os.remove(path)
+
+
+# 发送记录
+class DeliveryLedger:
+    """按 (用户, 周, 星期, 节次, 类型) 记录已发送的提醒，保证每条提醒只发送一次
+
+    记录同时写入数据库，重启后仍然有效；超过 ttl 秒的记录自动清除。
+    短时间内的登记和撤销合并为一次写入，一次汇总或整班的提醒只产生一个事务。
+    """
+
+    def __init__(self, storage: CourseStorage, writer: WriteBehindQueue, ttl: int = 2 * 86400,
+                 save_delay: float = 1.0):
+        self.storage = storage
+        self.writer = writer
+        self.ttl = ttl
+        self.save_delay = save_delay  # 合并写入的等待时间（秒）
+        self.entries = {}  # 键 -> 过期时间戳
+        self.deduped = 0  # 因已发送而跳过的提醒数
+        self._pending = {}  # 待写入的记录：键 -> 过期时间戳，None 表示删除
+        self._flush_handle = None
+
+    @staticmethod
+    def key(user_id: str, week: int, weekday: int, period: int, kind: str) -> str:
+        return f"{user_id}:{week}:{weekday}:{period}:{kind}"
+
+    def load(self):
+        """从数据库加载未过期的记录"""
+        self.entries = self.storage.load_deliveries(time.time())
+
+    def claim(self, key: str) -> bool:
+        """登记一条待发送的提醒，已发送过时返回 False"""
+        now = time.time()
+        if self.entries.get(key, 0) > now:
+            self.deduped += 1
+            return False
+        self.entries[key] = self._pending[key] = now + self.ttl
+        self._schedule_flush()
+        return True
+
+    def release(self, key: str):
+        """发送失败时撤销登记"""
+        if self.entries.pop(key, None) is not None:
+            self._pending[key] = None
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.save_delay, self.flush)
+
+    def flush(self):
+        """把待写入的记录作为一批交给写入线程"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pending:
+            self.writer.submit(self.storage.write_deliveries, self._pending)
+            self._pending = {}
+
+    def purge(self):
+        """清除过期记录"""
+        now = time.time()
+        self.entries = {key: expires_at for key, expires_at in self.entries.items() if expires_at > now}
+        self.writer.submit(self.storage.purge_deliveries, now)
+
+
+# 令牌桶限速
+class TokenBucket:
+    """每秒补充 rate 个令牌，最多积累 capacity 个"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# 消息发送队列
+class MessageDispatcher:
+    """并发数受限、按令牌桶限速的私聊消息发送队列
+
+    发送失败按指数退避重试，单个用户的失败不影响其他消息。
+    """
+
+    def __init__(self, concurrency: int = 4, rate: float = 5.0, burst: int = 10,
+                 max_retries: int = 3, retry_delay: float = 1.0):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.queue = None
+        self.workers = []
+        self.sent = 0  # 发送成功数
+        self.failed = 0  # 重试后仍失败的消息数
+        self.retries = 0  # 重试次数
+        self.latency = Histogram()  # 从入队到发送完成的耗时
+        self.started_at = time.monotonic()
+
+    def start(self):
+        """启动发送协程"""
+        if self.workers:
+            return
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def stop(self):
+        """停止发送协程，未发送的消息视为失败"""
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        while self.queue and not self.queue.empty():
+            *_, future, _ = self.queue.get_nowait()
+            if not future.done():
+                future.set_result(False)
+
+    def submit(self, bot: Bot, user_id: str, message: str) -> asyncio.Future:
+        """消息入队，返回的 future 在发送完成后得到 True/False"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((bot, user_id, message, future, time.monotonic()))
+        return future
+
+    async def send(self, bot: Bot, user_id: str, message: str) -> bool:
+        """发送一条消息并等待结果"""
+        return await self.submit(bot, user_id, message)
+
+    async def _worker(self):
+        while True:
+            bot, user_id, message, future, enqueued_at = await self.queue.get()
+            ok = False
+            for attempt in range(self.max_retries + 1):
+                await self.bucket.acquire()
+                try:
+                    await bot.send_private_msg(user_id=int(user_id), message=message)
+                    ok = True
+                    break
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        print(f"发送消息失败 {user_id}: {e}")
+                        break
+                    self.retries += 1
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+            latency = time.monotonic() - enqueued_at
+            if ok:
+                self.sent += 1
+                self.latency.observe(latency)
+            else:
+                self.failed += 1
+            if not future.done():
+                future.set_result(ok)
+            self.queue.task_done()
+
+    def stats(self) -> dict:
+        """吞吐量和延迟统计"""
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "pending": self.queue.qsize() if self.queue else 0,
+            "throughput": self.sent / elapsed,
+            "latency_avg": self.latency.avg,
+            "latency_max": self.latency.max,
+        }
+
+
+# 全局提醒调度器
+class ReminderScheduler:
+    """所有提醒时刻放在同一个优先队列里，只在下一个到期事件时唤醒
+
+    课程集合和时区都相同的用户组成一个订阅组，每个组只规划一份提醒，到期时一次发给组内所有用户。
+    """
+
+    def __init__(self, plugin, horizon_days: int = 2):
+        self.plugin = plugin
+        self.horizon_days = horizon_days  # 预先规划的天数
+        self.queue = []  # (提醒时间戳, 序号, 订阅组, 版本号, 周次, 课程)
+        self.groups = {}  # 订阅组 (课程集合哈希, 时区) -> (课程集合, {开启提醒的用户ID})
+        self.user_groups = {}  # 用户ID -> 所在订阅组
+        self.timezones = {}  # 时区名 -> {开启提醒的用户ID}，与订阅组一起增量维护，供每日通知分批使用
+        self.versions = {}  # 订阅组 -> 版本号，组被清空后旧条目出队时直接丢弃
+        self.planned_until = 0.0  # 队列已覆盖到的时间戳
+        self.bot = None
+        self.task = None
+        self.sending = set()  # 正在发送的提醒
+        self.tick = Histogram()  # 每次唤醒后规划和出队的耗时
+        self.errors = 0
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+
+    def _day_end(self, days: int) -> float:
+        """今天起第 days 天零点的时间戳"""
+        today = datetime.date.today() + datetime.timedelta(days=days)
+        return datetime.datetime.combine(today, datetime.time()).timestamp()
+
+    def _semester_days(self, since: float, until: float, zone) -> list:
+        """[since, until) 附近每天（按 zone 时区）的 (日期, (周, 星期), {分钟数: 时间戳})，不在学期内的日期跳过
+
+        最后一项缓存当天各个上下课时刻的时间戳，同一时区的订阅组共用。
+        """
+        days = []
+        day = datetime.datetime.fromtimestamp(since, zone).date()
+        last_day = datetime.datetime.fromtimestamp(until + self.plugin.reminder_time * 60, zone).date()
+        while day <= last_day:
+            semester_week = self.plugin.get_semester_week(day)
+            if semester_week is not None:
+                days.append((day, semester_week, {}))
+            day += datetime.timedelta(days=1)
+        return days
+
+    @staticmethod
+    def _instant(day: datetime.date, minutes: int, zone, stamps: dict) -> float:
+        """某天（按 zone 时区）距零点 minutes 分钟的墙上时刻的时间戳
+
+        按墙上时间构造而不是零点加偏移，夏令时切换当天的时刻也不会差一小时。
+        """
+        stamp = stamps.get(minutes)
+        if stamp is None:
+            moment = datetime.datetime.combine(day, datetime.time(minutes // 60, minutes % 60), zone)
+            stamp = stamps[minutes] = moment.timestamp()
+        return stamp
+
+    def _group_key(self, user_id: str):
+        """用户所属的订阅组，未开启提醒时返回 None"""
+        table = self.plugin.user_courses.get(user_id)
+        if table is None or not table.reminder_enabled:
+            return None
+        return table.course_set.digest, table.timezone
+
+    def _join(self, user_id: str) -> tuple:
+        """把用户加入对应的订阅组，返回 (订阅组, 是否新建)"""
+        key = self._group_key(user_id)
+        if key is None:
+            return None, False
+        group = self.groups.get(key)
+        created = group is None
+        if created:
+            group = self.groups[key] = (self.plugin.user_courses[user_id].course_set, set())
+        group[1].add(user_id)
+        self.user_groups[user_id] = key
+        self.timezones.setdefault(key[1], set()).add(user_id)
+        return key, created
+
+    def _leave(self, user_id: str):
+        """把用户移出订阅组，组被清空时作废它的条目"""
+        key = self.user_groups.pop(user_id, None)
+        if key is None:
+            return
+        zone_users = self.timezones[key[1]]
+        zone_users.discard(user_id)
+        if not zone_users:
+            del self.timezones[key[1]]
+        subscribers = self.groups[key][1]
+        subscribers.discard(user_id)
+        if not subscribers:
+            del self.groups[key]
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _plan_group(self, key: tuple, days: list, since: float, until: float, catch_up: bool) -> list:
+        """计算订阅组在 [since, until) 内的提醒条目
+
+        catch_up 为 True 时，提醒时间已过但课程尚未结束的课程也会立即提醒。
+        """
+        course_set = self.groups[key][0]
+        version = self.versions.get(key, 0)
+        lead = self.plugin.reminder_time * 60
+        zone = self.plugin.get_zone(key[1])
+        entries = []
+        for day, semester_week, stamps in days:
+            for course in course_set.courses_on(*semester_week):
+                start_minutes, end_minutes = self.plugin.get_course_minutes(course)
+                fire_ts = self._instant(day, start_minutes, zone, stamps) - lead
+                end_ts = self._instant(day, end_minutes, zone, stamps)
+                if fire_ts >= until or end_ts <= since:
+                    continue
+                if fire_ts < since and not catch_up:
+                    continue
+                self._seq += 1
+                entries.append((fire_ts, self._seq, key, version, semester_week[0], course))
+        return entries
+
+    def _plan_all(self, since: float, until: float, catch_up: bool) -> list:
+        """批量计算所有订阅组的条目，每个时区的学期日期只计算一次"""
+        days_by_zone = {}
+        entries = []
+        for key in self.groups:
+            timezone = key[1]
+            if timezone not in days_by_zone:
+                days_by_zone[timezone] = self._semester_days(since, until, self.plugin.get_zone(timezone))
+            if days_by_zone[timezone]:
+                entries.extend(self._plan_group(key, days_by_zone[timezone], since, until, catch_up))
+        return entries
+
+    def reindex(self):
+        """按课程集合和时区重新给所有开启提醒的用户分组"""
+        self.groups = {}
+        self.user_groups = {}
+        self.timezones = {}
+        for user_id in self.plugin.user_courses:
+            self._join(user_id)
+
+    def rehydrate(self):
+        """根据已保存的数据批量重建整个队列"""
+        self.reindex()
+        self.planned_until = self._day_end(self.horizon_days)
+        self.queue = self._plan_all(time.time(), self.planned_until, True)
+        heapq.heapify(self.queue)
+        self._wakeup.set()
+
+    def rebuild_user(self, user_id: str):
+        """用户提交课程、开关提醒或修改时区后，只调整该用户所在的订阅组"""
+        key = self._group_key(user_id)
+        if key is not None and self.user_groups.get(user_id) == key:
+            return  # 课程和时区都没有变化，已有条目仍然有效
+        self._leave(user_id)
+        key, created = self._join(user_id)
+        if key is None:
+            return
+        
+        # 新建的组规划全部条目；加入已有的组时只补上正在进行的课程，其他成员已发送过的由发送记录去重
+        now = time.time()
+        days = self._semester_days(now, self.planned_until, self.plugin.get_zone(key[1]))
+        for entry in self._plan_group(key, days, now, self.planned_until if created else now, True):
+            heapq.heappush(self.queue, entry)
+        self._wakeup.set()
+
+    def remove_user(self, user_id: str):
+        """移除用户的所有待发送提醒"""
+        self._leave(user_id)
+
+    def _extend(self):
+        """队列剩余覆盖不足一天时，再为所有用户规划一天"""
+        self.plugin.ledger.purge()
+        until = self.planned_until + 86400
+        self.queue.extend(self._plan_all(self.planned_until, until, False))
+        heapq.heapify(self.queue)
+        self.planned_until = until
+
+    def pop_due(self, now: float) -> list:
+        """弹出所有已到期的有效提醒，返回 (订阅用户列表, 周次, 课程)"""
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            _, _, key, version, week, course = heapq.heappop(self.queue)
+            group = self.groups.get(key)
+            if group is not None and version == self.versions.get(key, 0):
+                due.append((list(group[1]), week, course))
+        return due
+
+    async def run(self):
+        """调度循环"""
+        while True:
+            try:
+                with self.tick.time():
+                    now = time.time()
+                    while self.planned_until - now < 86400:
+                        self._extend()
+
+                    for user_ids, week, course in self.pop_due(now):
+                        task = asyncio.create_task(self._deliver(user_ids, week, course))
+                        self.sending.add(task)
+                        task.add_done_callback(self.sending.discard)
+
+                next_ts = self.queue[0][0] if self.queue else self.planned_until
+                timeout = max(0.0, min(next_ts, self.planned_until - 86400) - time.time())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                print(f"提醒调度出错: {e}")
+                await asyncio.sleep(60)
+
+    async def _deliver(self, user_ids: list, week: int, course: Course):
+        """把一条提醒一次性交给发送队列发给所有订阅用户，发送记录里已有的跳过"""
+        ledger = self.plugin.ledger
+        message = self.plugin.format_reminder(course)
+        pending = {}
+        for user_id in user_ids:
+            key = ledger.key(user_id, week, course.weekday, course.period, "reminder")
+            if ledger.claim(key):
+                pending[key] = self.plugin.dispatcher.submit(self.bot, user_id, message)
+        for key, future in pending.items():
+            if not await future:
+                ledger.release(key)
+
+    def start(self, bot: Bot):
+        """启动调度循环（已启动时只更新 bot）"""
+        self.bot = bot
+        if self.task is None or self.task.done():
+            self.rehydrate()
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        """停止调度循环"""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+
+def memory_usage() -> int:
+    """当前进程占用的内存（字节）：优先读取常驻内存，其次是峰值，都无法获取时返回 0"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def format_prometheus(metrics: list) -> str:
+    """把 (名称, 类型, 说明, 值或直方图) 列表转成 Prometheus 文本格式"""
+    lines = []
+    for name, kind, help_text, value in metrics:
+        name = f"kcjqr_{name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind != "histogram":
+            lines.append(f"{name} {value}")
+            continue
+        cumulative = 0
+        for bound, count in zip(value.buckets, value.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {value.count}')
+        lines.append(f"{name}_sum {value.sum}")
+        lines.append(f"{name}_count {value.count}")
+    return "\n".join(lines) + "\n"
+
 
 # 课程提醒插件
 class CourseReminderPlugin:
     def __init__(self):
         self.user_courses = {}  # 用户课程数据
-        self.reminder_tasks = {}  # 提醒任务
+        self.scheduler = ReminderScheduler(self)  # 提醒调度器
         self.semester_config = None  # 学期配置
+        self._semester_start = None  # 解析后的学期开始日期
+        self.period_times = []  # 全局作息时间（"HH:MM-HH:MM" 列表，为空时使用默认时间）
+        self._period_schedule = None  # 编译后的作息时间表
+        self.storage = CourseStorage()  # 数据存储
+        self.writer = WriteBehindQueue()  # 后台写入队列（数据库）
+        # 备份快照和指标文件另用一个线程写入，首次全量备份不会拖慢用户数据的写入，也不计入写入耗时
+        self.backup_writer = WriteBehindQueue("kcjqr-backup")
+        self.ledger = DeliveryLedger(self.storage, self.writer)  # 发送记录
+        self.save_delay = 1.0  # 合并写入的等待时间（秒）
+        self._dirty_users = set()  # 待写入的用户
+        self._dirty_semester = False  # 学期配置是否待写入
+        self._flush_handle = None
         self.reminder_time = 30  # 默认提醒时间（分钟）
         self.daily_notification_time = "23:00"  # 默认每日通知时间
+        self.daily_notification_window = 0  # 每日通知的分散发送窗口（分钟）
+        self.digest_cache = {}  # 用户ID -> (日期, 预先生成的汇总消息)
+        self.digest_batches = {}  # 通知截止时间戳 -> (该批次的发送任务, [时区名])
+        self._zones = {}  # 时区名 -> ZoneInfo
+        self.courses_per_page = 20  # 查看课程表时每条消息最多列出的课程数
         
         # 加载配置
         if hasattr(plugin_config, "reminder_time"):
             self.reminder_time = plugin_config.reminder_time
         if hasattr(plugin_config, "daily_notification_time"):
             self.daily_notification_time = plugin_config.daily_notification_time
+        if hasattr(plugin_config, "daily_notification_window"):
+            self.daily_notification_window = plugin_config.daily_notification_window
+        if hasattr(plugin_config, "period_times"):
+            self.period_times = plugin_config.period_times
         
-        # 加载数据
-        self.load_data()
+        # 消息发送队列
+        self.dispatcher = MessageDispatcher(
+            concurrency=getattr(plugin_config, "dispatch_concurrency", 4),
+            rate=getattr(plugin_config, "dispatch_rate", 5.0),
+            burst=getattr(plugin_config, "dispatch_burst", 10),
+            max_retries=getattr(plugin_config, "dispatch_max_retries", 3),
+        )
         
-        # 启动每日通知任务
+        # 数据在 NoneBot 启动后加载，任务在机器人连接后启动
+        self.bot = None
+        self.daily_task = None
+        self.backup_task = None
+        self.loaded = asyncio.Event()
+        
+        # 增量备份
+        self.backup_interval = getattr(plugin_config, "backup_interval", 60)  # 自动备份间隔（分钟），0 表示关闭
+        self.backups = BackupStore(
+            compression=getattr(plugin_config, "backup_compression", "gzip"),
+            keep_hourly=getattr(plugin_config, "backup_keep_hourly", 24),
+            keep_daily=getattr(plugin_config, "backup_keep_daily", 7),
+            keep_weekly=getattr(plugin_config, "backup_keep_weekly", 4),
+        )
+        self._backup_dirty = None  # 上次备份后修改过的用户，None 表示需要完整备份
+        
+        # 运行指标
+        self.metrics_interval = getattr(plugin_config, "metrics_interval", 60)  # 指标文件写入间隔（秒），0 表示关闭
+        self.metrics_path = os.path.join(DATA_DIR, "metrics.prom")
+        self.metrics_task = None
+        self.parse_latency = Histogram()  # 课程表解析耗时
+        self.flush_latency = Histogram()  # 在事件循环中生成待写入快照的耗时
+        digest_buckets = (0.1, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+        self.digest_precompute = Histogram(digest_buckets)  # 每批汇总消息的生成耗时
+        self.digest_send = Histogram(digest_buckets)  # 每批汇总消息从开始发送到全部完成的耗时
+        self.errors = 0  # 每日通知任务出错次数
+    
+    async def startup(self):
+        """在线程中加载数据，避免阻塞事件循环"""
+        await asyncio.get_running_loop().run_in_executor(None, self.load_data)
+        self.loaded.set()
+    
+    async def start(self, bot: Bot):
+        """机器人连接后启动提醒调度和每日通知"""
+        await self.loaded.wait()
+        self.bot = bot
+        self.scheduler.start(bot)
         self.start_daily_notification()
+        if self.backup_interval > 0 and (self.backup_task is None or self.backup_task.done()):
+            self.backup_task = asyncio.create_task(self.backup_loop())
+        if self.metrics_interval > 0 and (self.metrics_task is None or self.metrics_task.done()):
+            self.metrics_task = asyncio.create_task(self.metrics_loop())
     
     def load_data(self):
         """加载数据"""
         try:
-            # 加载课程数据
-            if os.path.exists("data/kcjqr/courses.json"):
-                with open("data/kcjqr/courses.json", "r", encoding="utf-8") as f:
-                    self.user_courses = json.load(f)
+            self.storage.open()
             
-            # 加载提醒状态
-            if os.path.exists("data/kcjqr/reminder_status.json"):
-                with open("data/kcjqr/reminder_status.json", "r", encoding="utf-8") as f:
-                    reminder_status = json.load(f)
-                    for user_id, status in reminder_status.items():
-                        if user_id in self.user_courses:
-                            self.user_courses[user_id]["reminder_enabled"] = status
+            # 首次启动时迁移旧版 JSON 数据
+            self.storage.migrate_json()
             
-            # 加载学期配置
-            if os.path.exists("data/kcjqr/semester_config.json"):
-                with open("data/kcjqr/semester_config.json", "r", encoding="utf-8") as f:
-                    self.semester_config = json.load(f)
+            self.user_courses, self.semester_config = self.storage.load_all()
+            self.ledger.load()
+            self._semester_start = None
+            self._period_schedule = None
         except Exception as e:
             print(f"加载数据失败: {e}")
     
-    def save_data(self):
-        """保存数据"""
-        try:
-            # 保存课程数据
-            with open("data/kcjqr/courses.json", "w", encoding="utf-8") as f:
-                json.dump(self.user_courses, f, ensure_ascii=False, indent=2)
-            
-            # 保存提醒状态
-            reminder_status = {
-                user_id: data.get("reminder_enabled", False)
-                for user_id, data in self.user_courses.items()
-            }
-            with open("data/kcjqr/reminder_status.json", "w", encoding="utf-8") as f:
-                json.dump(reminder_status, f, ensure_ascii=False, indent=2)
-            
-            # 保存学期配置
-            if self.semester_config:
-                with open("data/kcjqr/semester_config.json", "w", encoding="utf-8") as f:
-                    json.dump(self.semester_config, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"保存数据失败: {e}")
+    def save_user(self, user_id: str):
+        """标记用户数据待保存，短时间内的多次修改合并为一次写入"""
+        self._dirty_users.add(user_id)
+        if self._backup_dirty is not None:
+            self._backup_dirty.add(user_id)
+        self._schedule_flush()
     
-    def parse_course_info(self, text: str) -> dict:
-        """解析课程信息"""
+    def save_semester(self):
+        """标记学期配置待保存"""
+        self._dirty_semester = True
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            return
         try:
-            lines = text.strip().split("\n")
-            course_info = {
-                "basic_info": {},
-                "courses": []
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.save_delay, self.flush)
+    
+    def flush(self):
+        """把待保存的修改交给后台线程写入存储
+
+        在事件循环中只生成快照，序列化和写入都在写入线程中完成。
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        
+        with self.flush_latency.time():
+            users = {
+                user_id: self.user_courses[user_id].snapshot() if user_id in self.user_courses else None
+                for user_id in self._dirty_users
             }
-            
-            # 解析基本信息
-            for line in lines:
-                if "学期开始日期" in line:
-                    course_info["basic_info"]["start_date"] = line.split("：")[1].strip()
-                elif "总周数" in line:
-                    course_info["basic_info"]["total_weeks"] = int(line.split("：")[1].strip())
-            
-            # 解析课程信息
-            current_course = None
-            for line in lines:
-                if "第" in line and "周" in line and "星期" in line:
-                    if current_course:
-                        course_info["courses"].append(current_course)
-                    
-                    parts = line.split()
-                    week = int(parts[0][1:-1])
-                    weekday = "一二三四五六日".index(parts[1][2:]) + 1
-                    period = int(parts[2][1:-1])
-                    name = parts[3]
-                    
-                    current_course = {
-                        "week": week,
-                        "weekday": weekday,
-                        "period": period,
-                        "name": name,
-                        "location": "",
-                        "teacher": ""
-                    }
-                elif current_course:
-                    if "地点" in line:
-                        current_course["location"] = line.split("：")[1].strip()
-                    elif "教师" in line:
-                        current_course["teacher"] = line.split("：")[1].strip()
-            
-            if current_course:
-                course_info["courses"].append(current_course)
-            
-            return course_info
-        except Exception as e:
-            print(f"解析课程信息失败: {e}")
-            return None
+        semester_config = dict(self.semester_config) if self._dirty_semester and self.semester_config else None
+        self._dirty_users = set()
+        self._dirty_semester = False
+        if not users and semester_config is None:
+            return
+        
+        self.writer.submit(self.storage.write, users, semester_config)
+    
+    def persistence_stats(self) -> dict:
+        """写入队列深度、写入耗时和尚未提交的修改数"""
+        stats = self.writer.stats()
+        stats["dirty_users"] = len(self._dirty_users)
+        return stats
+    
+    def save_data(self):
+        """保存全部数据"""
+        self._dirty_users.update(self.user_courses)
+        self._dirty_semester = self.semester_config is not None
+        self.flush()
+    
+    def parse_course_info(self, text: str) -> tuple:
+        """解析课程信息，返回 (课程表, 错误列表)"""
+        with self.parse_latency.time():
+            return parse_timetable(text)
+    
+    def check_course_conflicts(self, courses: list, existing: CourseTable = None) -> list:
+        """检查课程冲突，返回 (课程1, 课程2, 冲突周次掩码)"""
+        return find_conflicts(courses, existing)
     
-    def check_course_conflicts(self, courses: list) -> list:
-        """检查课程冲突"""
-        conflicts = []
-        for i in range(len(courses)):
-            for j in range(i + 1, len(courses)):
-                c1, c2 = courses[i], courses[j]
-                if (c1["week"] == c2["week"] and 
-                    c1["weekday"] == c2["weekday"] and 
-                    c1["period"] == c2["period"]):
-                    conflicts.append((c1, c2))
-        return conflicts
+    def format_conflicts(self, conflicts: list) -> str:
+        """格式化冲突信息"""
+        return format_conflicts(conflicts)
+    
+    async def import_courses(self, path: str, enable: bool = False) -> tuple:
+        """批量导入课程表，返回 (成功导入的用户数, [(用户ID, 错误信息)])
+
+        读取文件、解析和冲突检查都在后台线程中进行，不阻塞事件循环；全部结果通过一次写入保存。
+        已有用户保留原来的提醒开关和时区，新用户在 enable 为 True 时开启提醒。
+        """
+        loop = asyncio.get_running_loop()
+        items = await loop.run_in_executor(None, read_import_source, path)
+        results = await loop.run_in_executor(None, import_timetables, items, self.parse_latency)
+        
+        failures = []
+        imported = []
+        for user_id, table, error in results:
+            if table is None:
+                failures.append((user_id, error))
+                continue
+            previous = self.user_courses.get(user_id)
+            if previous is not None:
+                table.reminder_enabled = previous.reminder_enabled
+                table.timezone = previous.timezone
+            else:
+                table.reminder_enabled = enable
+            self.user_courses[user_id] = table
+            self.invalidate_digest(user_id)
+            self._dirty_users.add(user_id)
+            if self._backup_dirty is not None:
+                self._backup_dirty.add(user_id)
+            imported.append(user_id)
+        
+        self.flush()
+        for user_id in imported:
+            self.scheduler.rebuild_user(user_id)
+        return len(imported), failures
     
     def backup_data(self):
-        """备份数据"""
+        """增量备份：只序列化上次备份后修改过的用户，在写入线程中生成快照"""
         try:
-            backup_dir = "data/kcjqr/backup"
-            os.makedirs(backup_dir, exist_ok=True)
-            
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = os.path.join(backup_dir, f"backup_{timestamp}")
-            os.makedirs(backup_path, exist_ok=True)
-            
-            # 备份课程数据
-            if os.path.exists("data/kcjqr/courses.json"):
-                with open("data/kcjqr/courses.json", "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                with open(os.path.join(backup_path, "courses.json"), "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            # 备份提醒状态
-            if os.path.exists("data/kcjqr/reminder_status.json"):
-                with open("data/kcjqr/reminder_status.json", "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                with open(os.path.join(backup_path, "reminder_status.json"), "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-            
-            # 备份学期配置
-            if os.path.exists("data/kcjqr/semester_config.json"):
-                with open("data/kcjqr/semester_config.json", "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                with open(os.path.join(backup_path, "semester_config.json"), "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
+            if self._backup_dirty is None:
+                changed = list(self.user_courses)
+            else:
+                changed = self._backup_dirty
+            changes = {
+                user_id: self.user_courses[user_id].snapshot() if user_id in self.user_courses else None
+                for user_id in changed
+            }
+            self._backup_dirty = set()
+            semester_config = dict(self.semester_config) if self.semester_config else None
             
+            # 快照内容已在事件循环中取出，不依赖数据库写入的进度
+            self.backup_writer.submit(self.backups.create, changes, semester_config)
             return True
         except Exception as e:
             print(f"备份数据失败: {e}")
             return False
     
-    def get_current_courses(self, courses: dict) -> list:
-        """获取当前课程"""
-        if not self.semester_config:
-            return []
-        
-        now = datetime.datetime.now()
-        start_date = parser.parse(self.semester_config["start_date"])
-        current_week = ((now - start_date).days // 7) + 1
-        
-        if current_week > self.semester_config["total_weeks"]:
-            return []
-        
-        current_weekday = now.weekday() + 1
-        current_time = now.time()
-        
-        result = []
-        for course in courses["courses"]:
-            if course["week"] == current_week and course["weekday"] == current_weekday:
-                # 计算课程开始和结束时间
-                start_minutes = (course["period"] - 1) * 45
-                end_minutes = course["period"] * 45
-                course_start = datetime.time(8, 0, 0) + datetime.timedelta(minutes=start_minutes)
-                course_end = datetime.time(8, 0, 0) + datetime.timedelta(minutes=end_minutes)
-                
-                # 计算提醒时间
-                reminder_datetime = datetime.datetime.combine(datetime.date.today(), course_start) - \
-                                  datetime.timedelta(minutes=self.reminder_time)
-                reminder_time = reminder_datetime.time()
-                
-                if reminder_time <= current_time <= course_end:
-                    course["time"] = f"{course_start.strftime('%H:%M')}-{course_end.strftime('%H:%M')}"
-                    result.append(course)
-        
-        return result
+    async def backup_loop(self):
+        """定时备份任务"""
+        while True:
+            await asyncio.sleep(self.backup_interval * 60)
+            self.backup_data()
     
-    def get_tomorrow_courses(self, courses: dict) -> list:
-        """获取明日课程"""
-        if not self.semester_config:
-            return []
+    async def restore_backup(self, name: str):
+        """从快照恢复全部数据"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.writer.drain)
+        await loop.run_in_executor(None, self.backup_writer.drain)
+        user_courses, semester_config = await loop.run_in_executor(None, self.backups.load, name)
         
-        now = datetime.datetime.now()
-        tomorrow = now + datetime.timedelta(days=1)
-        start_date = parser.parse(self.semester_config["start_date"])
-        current_week = ((tomorrow - start_date).days // 7) + 1
+        self.user_courses = user_courses
+        self.semester_config = semester_config
+        self._dirty_users = set()
+        self._dirty_semester = False
+        self._backup_dirty = None
+        self.writer.submit(
+            self.storage.replace_all,
+            {user_id: table.snapshot() for user_id, table in user_courses.items()},
+            semester_config,
+        )
+        self._semester_start = None
+        self._period_schedule = None
+        self.invalidate_digest()
+        self.scheduler.rehydrate()
+    
+    def semester_changed(self):
+        """学期配置修改后，清除缓存并重新安排提醒"""
+        self._semester_start = None
+        self._period_schedule = None
+        self.invalidate_digest()
+        self.save_semester()
+        self.scheduler.rehydrate()
+    
+    def get_semester_start(self):
+        """获取学期开始日期（解析结果会被缓存，/set_semester 时失效）
+
+        只用 /set_periods 设置过作息时间、还没有设置学期时返回 None。
+        """
+        if not self.semester_config or "start_date" not in self.semester_config:
+            return None
+        if self._semester_start is None:
+            self._semester_start = parser.parse(self.semester_config["start_date"]).date()
+        return self._semester_start
+    
+    def get_semester_week(self, day: datetime.date):
+        """获取某一天在学期中的 (周, 星期)，不在学期内时返回 None"""
+        start_date = self.get_semester_start()
+        if start_date is None:
+            return None
         
-        if current_week > self.semester_config["total_weeks"]:
+        days = (day - start_date).days
+        week = days // 7 + 1
+        total_weeks = self.semester_config.get("total_weeks")
+        if days < 0 or (total_weeks is not None and week > total_weeks):
+            return None
+        return week, day.weekday() + 1
+    
+    def get_courses_on(self, user_id: str, day: datetime.date) -> list:
+        """获取用户某一天的课程"""
+        semester_week = self.get_semester_week(day)
+        if semester_week is None or user_id not in self.user_courses:
             return []
-        
-        tomorrow_weekday = tomorrow.weekday() + 1
+        return self.user_courses[user_id].courses_on(*semester_week)
+    
+    def get_zone(self, name: str):
+        """时区名对应的 ZoneInfo，为空时返回 None（服务器本地时区）"""
+        if not name:
+            return None
+        if name not in self._zones:
+            self._zones[name] = zoneinfo.ZoneInfo(name)
+        return self._zones[name]
+    
+    def user_zone(self, user_id: str):
+        """用户设置的时区，未设置时返回 None"""
+        table = self.user_courses.get(user_id)
+        return self.get_zone(table.timezone) if table else None
+    
+    def user_now(self, user_id: str) -> datetime.datetime:
+        """用户所在时区的当前时间"""
+        return datetime.datetime.now(self.user_zone(user_id))
+    
+    def timezone_groups(self) -> dict:
+        """开启提醒的用户按时区分组：{时区名: {用户ID}}
+
+        由调度器在用户开关提醒、修改时区、提交或导入课程时增量维护，不需要遍历所有用户。
+        """
+        return self.scheduler.timezones
+    
+    def get_current_courses(self, user_id: str) -> list:
+        """获取当前课程"""
+        now = self.user_now(user_id)
+        current_minutes = now.hour * 60 + now.minute
         
         result = []
-        for course in courses["courses"]:
-            if course["week"] == current_week and course["weekday"] == tomorrow_weekday:
-                # 计算课程开始和结束时间
-                start_minutes = (course["period"] - 1) * 45
-                end_minutes = course["period"] * 45
-                course_start = datetime.time(8, 0, 0) + datetime.timedelta(minutes=start_minutes)
-                course_end = datetime.time(8, 0, 0) + datetime.timedelta(minutes=end_minutes)
-                course["time"] = f"{course_start.strftime('%H:%M')}-{course_end.strftime('%H:%M')}"
+        for course in self.get_courses_on(user_id, now.date()):
+            start_minutes, end_minutes = self.get_course_minutes(course)
+            if start_minutes - self.reminder_time <= current_minutes <= end_minutes:
                 result.append(course)
-        
         return result
     
-    def format_course_info(self, course_info: dict) -> str:
-        """格式化课程信息"""
-        msg = ""
-        if "basic_info" in course_info:
-            msg += f"学期开始日期：{course_info['basic_info']['start_date']}\n"
-            msg += f"总周数：{course_info['basic_info']['total_weeks']}\n\n"
+    def get_tomorrow_courses(self, user_id: str) -> list:
+        """获取明日课程"""
+        tomorrow = self.user_now(user_id).date() + datetime.timedelta(days=1)
+        return self.get_courses_on(user_id, tomorrow)
+    
+    def get_period_schedule(self) -> PeriodSchedule:
+        """获取作息时间表：学期配置中的 period_times 优先，其次是插件配置"""
+        if self._period_schedule is None:
+            periods = (self.semester_config or {}).get("period_times") or self.period_times
+            try:
+                self._period_schedule = PeriodSchedule(periods) if periods else PeriodSchedule.default()
+            except ValueError as e:
+                # 旧版本保存的作息时间可能不合法，此时使用默认时间
+                print(f"作息时间无效，使用默认时间: {e}")
+                self._period_schedule = PeriodSchedule.default()
+        return self._period_schedule
+    
+    def get_course_minutes(self, course: Course) -> tuple:
+        """获取课程（可能跨多节）的开始、结束时间（距零点的分钟数）"""
+        return self.get_period_schedule().span(course.period, course.period_end)
+    
+    def format_course_time(self, course: Course) -> str:
+        """课程时间文本，如 08:00-09:40"""
+        return self.get_period_schedule().label(course.period, course.period_end)
+    
+    def course_pages(self, table: CourseTable, week: int = None) -> list:
+        """课程表文本（week 为周次时只列出该周的课程），按 courses_per_page 分页
+
+        课程列表部分缓存在共享的课程集合中，课程不变时重复查看不会重新生成；
+        没有课程的周次不缓存，缓存条目数不超过有课的周数。
+        学期开始日期、总周数属于各个用户，每次单独拼接。
+        """
+        cache = table.render_cache(self.get_period_schedule())
+        bodies = cache.get(week)
+        if bodies is None:
+            bodies = self._render_bodies(table.courses, week)
+            if week is None or any(course.has_week(week) for course in table.courses):
+                cache[week] = bodies
         
-        msg += "课程信息：\n"
-        for course in course_info["courses"]:
-            # 计算课程时间
-            start_minutes = (course["period"] - 1) * 45
-            end_minutes = course["period"] * 45
-            course_start = datetime.time(8, 0, 0) + datetime.timedelta(minutes=start_minutes)
-            course_end = datetime.time(8, 0, 0) + datetime.timedelta(minutes=end_minutes)
-            course_time = f"{course_start.strftime('%H:%M')}-{course_end.strftime('%H:%M')}"
-            
-            msg += f"第{course['week']}周 星期{'一二三四五六日'[course['weekday']-1]} "
-            msg += f"第{course['period']}节 {course['name']}\n"
-            msg += f"时间：{course_time}\n"
-            msg += f"地点：{course['location']}\n"
-            msg += f"教师：{course['teacher']}\n\n"
+        header = []
+        if "start_date" in table.basic_info:
+            header.append(f"学期开始日期：{table.basic_info['start_date']}\n")
+        if "total_weeks" in table.basic_info:
+            header.append(f"总周数：{table.basic_info['total_weeks']}\n")
+        if header:
+            header.append("\n")
+        header.append("课程信息：\n" if week is None else f"第{week}周课程信息：\n")
+        header = "".join(header)
+        return [header + body for body in bodies]
+    
+    def _render_bodies(self, courses: list, week: int = None) -> list:
+        """分页后的课程列表文本（不含标题）"""
+        courses = sorted(courses, key=lambda c: (c.weekday, c.period))
+        if week is not None:
+            courses = [course for course in courses if course.has_week(week)]
+        if not courses:
+            return ["没有课程。\n"]
         
-        return msg
+        blocks = [
+            f"第{format_week_ranges(course.weeks)}周 星期{WEEKDAY_NAMES[course.weekday - 1]} "
+            f"第{format_periods(course)}节 {course.name}\n"
+            f"时间：{self.format_course_time(course)}\n"
+            f"地点：{course.location}\n"
+            f"教师：{course.teacher}\n\n"
+            for course in courses
+        ]
+        size = self.courses_per_page
+        total = (len(blocks) + size - 1) // size
+        bodies = []
+        for i in range(total):
+            parts = blocks[i * size:(i + 1) * size]
+            if total > 1:
+                parts.append(f"（第{i + 1}/{total}页")
+                if i + 1 < total:
+                    parts.append(f"，发送 /show_courses {week or 'all'} {i + 2} 查看下一页")
+                parts.append("）\n")
+            bodies.append("".join(parts))
+        return bodies
+    
+    def max_week(self, table: CourseTable) -> int:
+        """课程表可查看的最大周次：课程表写明的总周数，未写时为 MAX_WEEKS"""
+        total_weeks = table.basic_info.get("total_weeks")
+        return int(total_weeks) if str(total_weeks).isdigit() else MAX_WEEKS
+    
+    def format_course_info(self, table: CourseTable, week: int = None, page: int = 1) -> str:
+        """格式化课程信息（第 page 页）"""
+        return self.course_pages(table, week)[page - 1]
     
-    async def send_reminder(self, bot: Bot, user_id: str, course: dict):
+    def format_reminder(self, course: Course) -> str:
+        """上课提醒消息"""
+        return (
+            f"课程提醒：\n{course.name}\n"
+            f"时间：{self.format_course_time(course)}\n"
+            f"地点：{course.location}\n"
+            f"教师：{course.teacher}"
+        )
+    
+    async def send_reminder(self, bot: Bot, user_id: str, course: Course) -> bool:
         """发送提醒"""
-        msg = f"课程提醒：\n{course['name']}\n"
-        msg += f"时间：{course['time']}\n"
-        msg += f"地点：{course['location']}\n"
-        msg += f"教师：{course['teacher']}"
+        return await self.dispatcher.send(bot, user_id, self.format_reminder(course))
+    
+    def build_digest(self, user_id: str, day: datetime.date) -> str:
+        """生成某天的课程汇总消息，没有课程时返回空字符串"""
+        courses = self.get_courses_on(user_id, day)
+        if not courses:
+            return ""
+        parts = ["明日课程提醒：\n"]
+        for course in courses:
+            parts.append(
+                f"\n{course.name}\n"
+                f"时间：{self.format_course_time(course)}\n"
+                f"地点：{course.location}\n"
+                f"教师：{course.teacher}\n"
+            )
+        return "".join(parts)
+    
+    async def precompute_digests(self, day: datetime.date, user_ids: list, chunk_size: int = 500):
+        """提前生成指定用户的汇总消息，分批处理以免长时间占用事件循环"""
+        for i in range(0, len(user_ids), chunk_size):
+            for user_id in user_ids[i:i + chunk_size]:
+                cached = self.digest_cache.get(user_id)
+                if cached is None or cached[0] != day:
+                    self.digest_cache[user_id] = (day, self.build_digest(user_id, day))
+            await asyncio.sleep(0)
+    
+    def invalidate_digest(self, user_id: str = None):
+        """课程或学期变化后使缓存的汇总消息失效，发送时重新生成"""
+        if user_id is None:
+            self.digest_cache = {}
+        else:
+            self.digest_cache.pop(user_id, None)
+    
+    def get_digest_deadline(self, now: datetime.datetime) -> datetime.datetime:
+        """下一次每日通知的截止时间"""
+        target_time = datetime.datetime.strptime(self.daily_notification_time, "%H:%M").time()
+        deadline = datetime.datetime.combine(now.date(), target_time, now.tzinfo)
+        if now > deadline:
+            deadline = datetime.datetime.combine(
+                now.date() + datetime.timedelta(days=1), target_time, now.tzinfo)
+        return deadline
+    
+    def digest_groups(self) -> dict:
+        """按通知截止时刻给时区分批：{截止时间戳: (次日日期, 零点时间戳, [时区名])}
+
+        通知时间按用户所在时区计算，截止时刻相同的时区合并为一批；只遍历时区，不遍历用户。
+        """
+        groups = {}
+        for timezone in self.timezone_groups():
+            zone = self.get_zone(timezone)
+            deadline = self.get_digest_deadline(datetime.datetime.now(zone))
+            rollover = datetime.datetime.combine(deadline.date(), datetime.time(), zone)
+            day = deadline.date() + datetime.timedelta(days=1)
+            group = groups.setdefault(deadline.timestamp(), (day, rollover.timestamp(), []))
+            group[2].append(timezone)
+        return groups
+    
+    def digest_users(self, timezones: list) -> list:
+        """当前属于某个通知批次的用户
+
+        批次的时区在创建时确定，不再按当前时间重新计算截止时刻（截止时刻过后会滚动到次日）；
+        用户按时区当前的分组取出，等待期间修改了时区的用户会跟着时区走。
+        """
+        groups = self.timezone_groups()
+        return [user_id for timezone in timezones for user_id in groups.get(timezone, ())]
+    
+    async def send_digests(self, bot: Bot, day: datetime.date, window_start: float, window: float,
+                           user_ids: list):
+        """在 [window_start, window_start + window] 内分散发送指定用户的汇总消息"""
+        semester_week = self.get_semester_week(day)
+        if semester_week is None:
+            return
         
-        await bot.send_private_msg(user_id=int(user_id), message=msg)
+        # 每个用户在窗口内的发送时间固定（按用户ID哈希），重启后不变
+        schedule = sorted(
+            (window_start + (zlib.crc32(user_id.encode()) % int(window) if window >= 1 else 0), user_id)
+            for user_id in user_ids
+        )
+        
+        started = time.monotonic()
+        pending = {}
+        for send_at, user_id in schedule:
+            delay = send_at - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if user_id not in self.user_courses or not self.user_courses[user_id].reminder_enabled:
+                continue
+            
+            cached = self.digest_cache.get(user_id)
+            if cached is not None and cached[0] == day:
+                msg = cached[1]
+            else:
+                msg = self.build_digest(user_id, day)
+                self.digest_cache[user_id] = (day, msg)
+            key = self.ledger.key(user_id, *semester_week, 0, "daily")
+            if msg and self.ledger.claim(key):
+                pending[key] = self.dispatcher.submit(bot, user_id, msg)
+        
+        failed = 0
+        for key, future in pending.items():
+            if not await future:
+                self.ledger.release(key)
+                failed += 1
+        print(f"明日课程提醒发送完成：成功 {len(pending) - failed}，失败 {failed}，"
+              f"用时 {time.monotonic() - started:.1f} 秒")
     
-    async def reminder_task(self, bot: Bot, user_id: str):
-        """提醒任务"""
-        while True:
-            try:
-                if user_id in self.user_courses and self.user_courses[user_id].get("reminder_enabled", False):
-                    courses = self.user_courses[user_id]
-                    current_courses = self.get_current_courses(courses)
-                    
-                    for course in current_courses:
-                        await self.send_reminder(bot, user_id, course)
-                
-                await asyncio.sleep(60)  # 每分钟检查一次
-            except Exception as e:
-                print(f"提醒任务出错: {e}")
-                await asyncio.sleep(60)
+    async def digest_batch(self, deadline_ts: float, day: datetime.date, rollover_ts: float,
+                           timezones: list):
+        """发送一个批次的每日通知：零点后生成次日汇总，在通知时间前的窗口内分散发送
+
+        timezones 是该批次的时区列表，等待期间新出现的同批次时区会追加进来。
+        """
+        try:
+            # 等到截止日的零点再生成，保证当天的课程修改已经生效
+            delay = rollover_ts - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            with self.digest_precompute.time():
+                await self.precompute_digests(day, self.digest_users(timezones))
+            
+            window = self.daily_notification_window * 60
+            window_start = deadline_ts - window
+            delay = window_start - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            with self.digest_send.time():
+                await self.send_digests(self.bot, day, window_start, window, self.digest_users(timezones))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            print(f"每日通知任务出错: {e}")
     
-    async def daily_notification_task(self, bot: Bot):
-        """每日通知任务"""
+    async def daily_notification_task(self):
+        """每日通知任务：为每个通知截止时刻（按用户时区）启动一个发送批次"""
         while True:
             try:
-                now = datetime.datetime.now()
-                target_time = datetime.datetime.strptime(self.daily_notification_time, "%H:%M").time()
-                target_datetime = datetime.datetime.combine(now.date(), target_time)
-                
-                if now.time() > target_time:
-                    target_datetime += datetime.timedelta(days=1)
+                now = time.time()
+                for deadline_ts, (task, _) in list(self.digest_batches.items()):
+                    # 截止时刻过去后该批次不会再出现，保留到那时以免重复发送
+                    if task.done() and deadline_ts < now:
+                        del self.digest_batches[deadline_ts]
                 
-                wait_seconds = (target_datetime - now).total_seconds()
-                await asyncio.sleep(wait_seconds)
+                for deadline_ts, (day, rollover_ts, timezones) in self.digest_groups().items():
+                    batch = self.digest_batches.get(deadline_ts)
+                    if batch is None:
+                        task = asyncio.create_task(self.digest_batch(deadline_ts, day, rollover_ts, timezones))
+                        self.digest_batches[deadline_ts] = (task, timezones)
+                    else:
+                        # 批次已在等待，把新出现的时区并入该批次
+                        batch[1].extend(timezone for timezone in timezones if timezone not in batch[1])
                 
-                for user_id, courses in self.user_courses.items():
-                    if courses.get("reminder_enabled", False):
-                        tomorrow_courses = self.get_tomorrow_courses(courses)
-                        if tomorrow_courses:
-                            msg = "明日课程提醒：\n"
-                            for course in tomorrow_courses:
-                                msg += f"\n{course['name']}\n"
-                                msg += f"时间：{course['time']}\n"
-                                msg += f"地点：{course['location']}\n"
-                                msg += f"教师：{course['teacher']}\n"
-                            
-                            await bot.send_private_msg(user_id=int(user_id), message=msg)
-                
-                await asyncio.sleep(60)  # 等待一分钟，避免重复发送
+                await asyncio.sleep(60)  # 定期检查新出现的时区
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
+                self.errors += 1
                 print(f"每日通知任务出错: {e}")
                 await asyncio.sleep(60)
     
+    def collect_metrics(self) -> list:
+        """当前的运行指标：(名称, 类型, 说明, 值或直方图)
+
+        发送队列和写入队列的计数来自各自的 stats()。
+        """
+        dispatcher = self.dispatcher
+        dispatch = dispatcher.stats()
+        persistence = self.persistence_stats()
+        return [
+            ("users", "gauge", "Users with a timetable", len(self.user_courses)),
+            ("reminder_users", "gauge", "Users with reminders enabled",
+             sum(1 for table in self.user_courses.values() if table.reminder_enabled)),
+            ("messages_sent_total", "counter", "Messages sent successfully", dispatch["sent"]),
+            ("messages_failed_total", "counter", "Messages that failed after all retries", dispatch["failed"]),
+            ("messages_retried_total", "counter", "Send retries", dispatch["retries"]),
+            ("send_throughput", "gauge", "Messages sent per second since start", dispatch["throughput"]),
+            ("reminders_deduped_total", "counter", "Reminders skipped because they were already sent",
+             self.ledger.deduped),
+            ("scheduler_errors_total", "counter", "Errors in the reminder scheduler loop", self.scheduler.errors),
+            ("daily_errors_total", "counter", "Errors in the daily notification task", self.errors),
+            ("write_errors_total", "counter", "Failed storage writes", persistence["errors"]),
+            ("writes_total", "counter", "Completed storage writes", persistence["completed"]),
+            ("scheduler_queue_entries", "gauge", "Planned reminders in the scheduler queue",
+             len(self.scheduler.queue)),
+            ("reminder_groups", "gauge", "Subscriber groups sharing a course set and timezone",
+             len(self.scheduler.groups)),
+            ("course_sets", "gauge", "Distinct course sets in the shared catalog", CourseSet.catalog_size()),
+            ("sending_tasks", "gauge", "Reminder deliveries in progress", len(self.scheduler.sending)),
+            ("digest_batches", "gauge", "Daily notification batches waiting or sending", len(self.digest_batches)),
+            ("asyncio_tasks", "gauge", "Tasks on the event loop", len(asyncio.all_tasks())),
+            ("dispatch_pending", "gauge", "Messages waiting in the send queue", dispatch["pending"]),
+            ("write_queue_depth", "gauge", "Jobs waiting in the write-behind queue", persistence["queue_depth"]),
+            ("write_latency_last_seconds", "gauge", "Latency of the most recent storage write",
+             persistence["latency_last"]),
+            ("dirty_users", "gauge", "Users with changes not yet submitted for writing", persistence["dirty_users"]),
+            ("backup_queue_depth", "gauge", "Backup and metrics jobs waiting on their own writer thread",
+             self.backup_writer.jobs.qsize()),
+            ("memory_bytes", "gauge", "Resident memory of the process", memory_usage()),
+            ("scheduler_tick_seconds", "histogram", "Scheduler planning and dequeue time per wakeup",
+             self.scheduler.tick),
+            ("send_latency_seconds", "histogram", "Time from enqueue to successful send", dispatcher.latency),
+            ("parse_seconds", "histogram", "Timetable parse time", self.parse_latency),
+            ("flush_seconds", "histogram", "Snapshot time on the event loop per flush", self.flush_latency),
+            ("write_latency_seconds", "histogram", "Time from submit to completed storage write",
+             self.writer.latency),
+            ("write_duration_seconds", "histogram", "Storage write execution time", self.writer.duration),
+            ("digest_precompute_seconds", "histogram", "Daily digest generation time per batch",
+             self.digest_precompute),
+            ("digest_send_seconds", "histogram", "Daily digest send completion time per batch", self.digest_send),
+        ]
+    
+    def format_stats(self) -> str:
+        """/kcjqr_stats 显示的运行状态"""
+        metrics = {name: value for name, _, _, value in self.collect_metrics()}
+        msg = "运行状态：\n"
+        msg += (f"用户：{metrics['users']}（开启提醒 {metrics['reminder_users']}），"
+                f"不同课程表 {metrics['course_sets']}，提醒订阅组 {metrics['reminder_groups']}\n")
+        msg += (f"提醒队列：{metrics['scheduler_queue_entries']} 条，发送中 {metrics['sending_tasks']}，"
+                f"汇总批次 {metrics['digest_batches']}，异步任务 {metrics['asyncio_tasks']}\n")
+        msg += (f"消息：成功 {metrics['messages_sent_total']}，失败 {metrics['messages_failed_total']}，"
+                f"重试 {metrics['messages_retried_total']}，去重跳过 {metrics['reminders_deduped_total']}\n")
+        msg += (f"错误：调度 {metrics['scheduler_errors_total']}，每日通知 {metrics['daily_errors_total']}，"
+                f"写入 {metrics['write_errors_total']}\n")
+        msg += (f"发送队列：待发送 {metrics['dispatch_pending']}，"
+                f"平均 {metrics['send_throughput']:.2f} 条/秒\n")
+        msg += (f"写入队列：待写入 {metrics['write_queue_depth']}，待提交用户 {metrics['dirty_users']}，"
+                f"已完成 {metrics['writes_total']}，最近一次 {metrics['write_latency_last_seconds'] * 1000:.1f} 毫秒\n")
+        msg += f"内存：{metrics['memory_bytes'] / 1024 / 1024:.1f} MB\n"
+        msg += "\n耗时（次数 平均/P99/最大，毫秒）："
+        for label, name in (
+            ("调度", "scheduler_tick_seconds"),
+            ("发送", "send_latency_seconds"),
+            ("解析", "parse_seconds"),
+            ("保存快照", "flush_seconds"),
+            ("写入", "write_duration_seconds"),
+            ("汇总生成", "digest_precompute_seconds"),
+            ("汇总发送", "digest_send_seconds"),
+        ):
+            histogram = metrics[name]
+            msg += (f"\n{label}：{histogram.count} {histogram.avg * 1000:.1f}/"
+                    f"{histogram.quantile(0.99) * 1000:.0f}/{histogram.max * 1000:.1f}")
+        return msg
+    
+    def _write_metrics(self, text: str):
+        """在写入线程中写入指标文件"""
+        os.makedirs(os.path.dirname(self.metrics_path), exist_ok=True)
+        with open(self.metrics_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(self.metrics_path + ".tmp", self.metrics_path)
+    
+    def write_metrics(self):
+        """生成 Prometheus 格式的指标文本，交给备份线程写入 data/kcjqr/metrics.prom"""
+        self.backup_writer.submit(self._write_metrics, format_prometheus(self.collect_metrics()))
+    
+    async def metrics_loop(self):
+        """定时写入指标文件"""
+        while True:
+            self.write_metrics()
+            await asyncio.sleep(self.metrics_interval)
+    
     def start_daily_notification(self):
-        """启动每日通知任务"""
-        bot = get_driver().bots[list(get_driver().bots.keys())[0]]
-        asyncio.create_task(self.daily_notification_task(bot))
+        """启动每日通知任务（已启动时不重复启动）"""
+        if self.daily_task is None or self.daily_task.done():
+            self.daily_task = asyncio.create_task(self.daily_notification_task())
     
     def terminate(self):
         """终止插件"""
-        # 保存数据
-        self.save_data()
+        # 停止提醒调度、每日通知和消息发送
+        self.scheduler.stop()
+        batches = [task for task, _ in self.digest_batches.values()]
+        for task in (self.daily_task, self.backup_task, self.metrics_task, *batches):
+            if task:
+                task.cancel()
+        self.digest_batches = {}
+        self.daily_task = None
+        self.backup_task = None
+        self.metrics_task = None
+        self.dispatcher.stop()
         
-        # 取消所有任务
-        for task in self.reminder_tasks.values():
-            task.cancel()
+        # 写入未保存的修改，等待写入线程完成后再关闭数据库
+        self.flush()
+        self.ledger.flush()
+        self.writer.stop()
+        self.backup_writer.stop()
+        self.storage.close()
 
 # 创建插件实例
 plugin = CourseReminderPlugin()
@@ -349,6 +2162,7 @@ course_handler = on_message(rule=to_me(), priority=5)
 @course_handler.handle()
 async def handle_course(bot: Bot, event: Event, state: T_State):
     """处理课程消息"""
+    await plugin.loaded.wait()
     user_id = str(event.get_user_id())
     
     # 处理图片或文件
@@ -386,30 +2200,113 @@ async def handle_course(bot: Bot, event: Event, state: T_State):
                 total_weeks = int(cmd[2])
                 
                 plugin.semester_config = {
+                    **(plugin.semester_config or {}),
                     "start_date": start_date.strftime("%Y-%m-%d"),
                     "total_weeks": total_weeks
                 }
-                plugin.save_data()
+                plugin.semester_changed()
                 
                 await course_handler.finish(f"学期信息设置成功：\n开始日期：{cmd[1]}\n总周数：{total_weeks}")
             except Exception as e:
                 await course_handler.finish(f"设置学期信息失败：{e}")
             return
         
+        if cmd[0] == "set_periods":
+            try:
+                # 不带参数时恢复使用插件配置中的作息时间
+                schedule = PeriodSchedule(cmd[1:]) if len(cmd) > 1 else None
+            except ValueError as e:
+                await course_handler.finish(f"设置作息时间失败：{e}\n请使用格式：/set_periods 08:00-08:45 08:55-09:40 ...")
+                return
+            
+            plugin.semester_config = dict(plugin.semester_config or {})
+            if schedule is None:
+                plugin.semester_config.pop("period_times", None)
+            else:
+                plugin.semester_config["period_times"] = cmd[1:]
+            plugin.semester_changed()
+            
+            if schedule is None:
+                await course_handler.finish("已恢复默认作息时间。")
+            else:
+                msg = "作息时间设置成功：\n"
+                msg += "\n".join(f"第{i}节 {schedule.label(i, i)}" for i in range(1, len(cmd)))
+                await course_handler.finish(msg)
+            return
+        
+        if cmd[0] in ("backup_now", "list_backups", "restore_backup"):
+            if not await SUPERUSER(bot, event):
+                await course_handler.finish("该命令仅限超级用户使用。")
+                return
+            
+            if cmd[0] == "backup_now":
+                plugin.backup_data()
+                await course_handler.finish("已开始备份。")
+                return
+            
+            snapshots = plugin.backups.list_snapshots()
+            if cmd[0] == "list_backups":
+                if not snapshots:
+                    await course_handler.finish("暂无备份。")
+                    return
+                msg = "备份列表（最近20个）：\n" + "\n".join(reversed(snapshots[-20:]))
+                await course_handler.finish(msg)
+                return
+            
+            if len(cmd) != 2 or cmd[1] not in snapshots:
+                await course_handler.finish("请使用正确的格式：/restore_backup <备份名称>，可通过 /list_backups 查看")
+                return
+            try:
+                await plugin.restore_backup(cmd[1])
+            except Exception as e:
+                await course_handler.finish(f"恢复备份失败：{e}")
+                return
+            await course_handler.finish(f"已从备份 {cmd[1]} 恢复 {len(plugin.user_courses)} 个用户的数据。")
+            return
+        
+        if cmd[0] == "import_courses":
+            if not await SUPERUSER(bot, event):
+                await course_handler.finish("该命令仅限超级用户使用。")
+                return
+            if len(cmd) < 2 or (len(cmd) == 3 and cmd[2] != "enable") or len(cmd) > 3:
+                await course_handler.finish("请使用正确的格式：/import_courses <文件或目录路径> [enable]")
+                return
+            
+            try:
+                imported, failures = await plugin.import_courses(cmd[1], len(cmd) == 3)
+            except (OSError, ValueError, KeyError) as e:
+                await course_handler.finish(f"导入失败：{e}")
+                return
+            
+            msg = f"已导入 {imported} 个用户的课程表。"
+            if failures:
+                msg += f"\n以下 {len(failures)} 个用户导入失败：\n"
+                msg += "\n".join(f"{user_id}：{error}" for user_id, error in failures[:20])
+                if len(failures) > 20:
+                    msg += f"\n……共 {len(failures)} 个"
+            await course_handler.finish(msg)
+            return
+        
+        if cmd[0] == "kcjqr_stats":
+            if not await SUPERUSER(bot, event):
+                await course_handler.finish("该命令仅限超级用户使用。")
+                return
+            
+            plugin.write_metrics()
+            await course_handler.finish(plugin.format_stats())
+            return
+        
         if cmd[0] == "enable_reminder":
             if user_id not in plugin.user_courses:
                 await course_handler.finish("请先发送课程信息。")
                 return
             
-            plugin.user_courses[user_id]["reminder_enabled"] = True
-            plugin.save_data()
+            plugin.user_courses[user_id].reminder_enabled = True
+            plugin.save_user(user_id)
             
-            # 启动提醒任务
-            if user_id not in plugin.reminder_tasks:
-                bot = get_driver().bots[list(get_driver().bots.keys())[0]]
-                plugin.reminder_tasks[user_id] = asyncio.create_task(
-                    plugin.reminder_task(bot, user_id)
-                )
+            # 加入提醒调度
+            plugin.scheduler.start(bot)
+            plugin.scheduler.rebuild_user(user_id)
             
             await course_handler.finish("课程提醒已开启。")
             return
@@ -419,24 +2316,93 @@ async def handle_course(bot: Bot, event: Event, state: T_State):
                 await course_handler.finish("请先发送课程信息。")
                 return
             
-            plugin.user_courses[user_id]["reminder_enabled"] = False
-            plugin.save_data()
+            plugin.user_courses[user_id].reminder_enabled = False
+            plugin.save_user(user_id)
             
-            # 取消提醒任务
-            if user_id in plugin.reminder_tasks:
-                plugin.reminder_tasks[user_id].cancel()
-                del plugin.reminder_tasks[user_id]
+            # 移出提醒调度
+            plugin.scheduler.remove_user(user_id)
             
             await course_handler.finish("课程提醒已关闭。")
             return
         
+        if cmd[0] == "set_timezone":
+            if user_id not in plugin.user_courses:
+                await course_handler.finish("请先发送课程信息。")
+                return
+            
+            # 不带参数时恢复使用服务器时区
+            timezone = cmd[1] if len(cmd) > 1 else ""
+            try:
+                plugin.get_zone(timezone)
+            except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+                await course_handler.finish(f"未知时区：{timezone}\n请使用 IANA 时区名，如 /set_timezone Asia/Shanghai")
+                return
+            
+            plugin.user_courses[user_id].timezone = timezone
+            plugin.invalidate_digest(user_id)
+            plugin.save_user(user_id)
+            plugin.scheduler.rebuild_user(user_id)
+            
+            await course_handler.finish(f"时区已设置为：{timezone or '服务器时区'}")
+            return
+        
+        if cmd[0] == "add_courses":
+            if user_id not in plugin.user_courses:
+                await course_handler.finish("请先发送课程信息。")
+                return
+            if len(cmd) < 2:
+                await course_handler.finish("请使用正确的格式：/add_courses 后换行附上要追加的课程信息")
+                return
+
+            new_table, errors = plugin.parse_course_info(text.split(None, 1)[1])
+            if errors or not new_table.courses:
+                await course_handler.finish("解析课程信息失败，请检查格式是否正确。")
+                return
+
+            # 只检查新课程之间以及新课程与已有课程的冲突
+            table = plugin.user_courses[user_id]
+            conflicts = plugin.check_course_conflicts(new_table.courses, table)
+            if conflicts:
+                await course_handler.finish(plugin.format_conflicts(conflicts))
+                return
+
+            table.extend(new_table.courses)
+            plugin.invalidate_digest(user_id)
+            plugin.save_user(user_id)
+            plugin.scheduler.rebuild_user(user_id)
+
+            await course_handler.finish(f"已追加 {len(new_table.courses)} 门课程。")
+            return
+
         if cmd[0] == "show_courses":
             if user_id not in plugin.user_courses:
                 await course_handler.finish("请先发送课程信息。")
                 return
             
-            msg = plugin.format_course_info(plugin.user_courses[user_id])
-            await course_handler.finish(msg)
+            # /show_courses [周次|all] [页码]
+            week = None
+            page = 1
+            try:
+                if len(cmd) > 1 and cmd[1] != "all":
+                    week = int(cmd[1])
+                    if week < 1:
+                        raise ValueError
+                if len(cmd) > 2:
+                    page = int(cmd[2])
+            except ValueError:
+                await course_handler.finish("请使用正确的格式：/show_courses [周次|all] [页码]")
+                return
+            
+            table = plugin.user_courses[user_id]
+            if week is not None and week > plugin.max_week(table):
+                await course_handler.finish(f"周次超出范围，最多 {plugin.max_week(table)} 周。")
+                return
+            
+            pages = plugin.course_pages(table, week)
+            if not 1 <= page <= len(pages):
+                await course_handler.finish(f"页码超出范围，共 {len(pages)} 页。")
+                return
+            await course_handler.finish(pages[page - 1])
             return
         
         if cmd[0] == "test_reminder":
@@ -444,8 +2410,7 @@ async def handle_course(bot: Bot, event: Event, state: T_State):
                 await course_handler.finish("请先发送课程信息。")
                 return
             
-            courses = plugin.user_courses[user_id]
-            current_courses = plugin.get_current_courses(courses)
+            current_courses = plugin.get_current_courses(user_id)
             
             if not current_courses:
                 await course_handler.finish("当前没有课程。")
@@ -461,32 +2426,50 @@ async def handle_course(bot: Bot, event: Event, state: T_State):
         return
     
     # 解析课程信息
-    course_info = plugin.parse_course_info(text)
-    if not course_info:
+    table, errors = plugin.parse_course_info(text)
+    if errors:
+        msg = "解析课程信息失败，以下行格式有误：\n"
+        for line_no, error in errors[:10]:
+            msg += f"\n第{line_no}行：{error}"
+        if len(errors) > 10:
+            msg += f"\n……共 {len(errors)} 处错误"
+        await course_handler.finish(msg)
+        return
+    if not table.courses:
         await course_handler.finish("解析课程信息失败，请检查格式是否正确。")
         return
     
     # 检查课程冲突
-    conflicts = plugin.check_course_conflicts(course_info["courses"])
+    conflicts = plugin.check_course_conflicts(table.courses)
     if conflicts:
-        msg = "发现课程冲突：\n"
-        for c1, c2 in conflicts:
-            msg += f"\n{c1['name']} 与 {c2['name']} 在"
-            msg += f"第{c1['week']}周 星期{'一二三四五六日'[c1['weekday']-1]} "
-            msg += f"第{c1['period']}节 冲突\n"
-        await course_handler.finish(msg)
+        await course_handler.finish(plugin.format_conflicts(conflicts))
         return
     
-    # 保存课程信息
-    plugin.user_courses[user_id] = course_info
-    plugin.save_data()
+    # 保存课程信息（保留原有的提醒开关和时区）
+    if user_id in plugin.user_courses:
+        table.reminder_enabled = plugin.user_courses[user_id].reminder_enabled
+        table.timezone = plugin.user_courses[user_id].timezone
+    plugin.user_courses[user_id] = table
+    plugin.invalidate_digest(user_id)
+    plugin.save_user(user_id)
+    plugin.scheduler.rebuild_user(user_id)
     
     # 显示课程信息
     msg = "课程信息已保存：\n"
-    msg += plugin.format_course_info(course_info)
+    msg += plugin.format_course_info(table)
     msg += "\n使用 /enable_reminder 开启提醒功能。"
     await course_handler.finish(msg)
 
+# 启动时加载数据
+@driver.on_startup
+async def startup():
+    await plugin.startup()
+
+# 机器人连接后恢复提醒调度和每日通知
+@driver.on_bot_connect
+async def bot_connect(bot: Bot):
+    await plugin.start(bot)
+
 # 注册终止函数
 @driver.on_shutdown
 async def shutdown():